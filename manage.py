@@ -1,27 +1,41 @@
 import click
 import codecs
+import collections
+import contextlib
 import csv
 import datetime
+import hashlib
+import io
 import json
+import mmap
 import os
-import requests
+import pathlib
+import shutil
+import struct
 import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
 import warnings
-import xlsxwriter
-import yaml
+import zlib
 
-from ocdskit.mapping_sheet import mapping_sheet
-from xlsxwriter.utility import xl_col_to_name
+from click.core import ParameterSource
+
+# requests, xlsxwriter, yaml, ocdskit and the standard library modules for concurrency, archives and pickling are
+# imported by the functions that use them, so that commands that don't need them, like --help, start quickly.
 
 # https://flatten-tool.readthedocs.io/en/latest/unflatten/#metadata-tab
 # https://flatten-tool.readthedocs.io/en/latest/unflatten/#configuration-properties-skip-and-header-rows
-META_CONFIG = ["#", "hashComments"]
+META_CONFIG = ("#", "hashComments")
 
 
 def get(url):
     """
     GETs a URL and returns the response. Raises an exception if the status code is not successful.
     """
+    import requests
+
     response = requests.get(url)
     response.raise_for_status()
     response.encoding = response.apparent_encoding
@@ -37,129 +51,33 @@ def json_dump(filename, data):
         f.write("\n")
 
 
-def delete_directory_contents(directory_path):
+def write_file(filename, content):
     """
-    Deletes the contents of a directory on disk.
+    Writes the content, a string or bytes, to the given filename atomically, so that concurrent readers and writers of
+    the file never see a partial file.
     """
-    if os.path.isdir(directory_path):
-        for filename in os.listdir(directory_path):
-            file_path = os.path.join(directory_path, filename)
-            try:
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    os.unlink(file_path)
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
-            except Exception as e:
-                print("Failed to delete %s. Reason: %s" % (file_path, e))
+    mode = "wb" if isinstance(content, bytes) else "w"
+    with tempfile.NamedTemporaryFile(mode, dir=os.path.dirname(filename) or ".", delete=False) as f:
+        f.write(content)
+    os.replace(f.name, filename)
 
 
 def configure(ctx, param, filename):
     if filename:
+        import yaml
+
         with open(filename, "r") as f:
             config = yaml.safe_load(f)
         ctx.default_map = config
+        ctx.meta["config_file"] = filename
 
 
-@click.group()
-def cli():
-    pass
-
-
-@cli.command()
-@click.argument('schemafile', type=click.Path(exists=True))
-@click.option(
-    "-c",
-    "--config-file",
-    type=click.Path(dir_okay=False),
-    callback=configure,
-    is_eager=True,
-    expose_value=False,
-    help="Read option defaults from the specified YAML file.",
-    show_default=True,
-)
-@click.option(
-    "-o",
-    "--output-file",
-    type=click.Path(dir_okay=False),
-    default="template.xlsx",
-    help="Path to which to write the template.",
-    show_default=True,
-)
-@click.option(
-    "-b",
-    "--codelist-base-url",
-    type=str,
-    default=None,
-    help="The base URL at which codelist CSV files are available.",
-)
-@click.option(
-    "-d",
-    "--codelist-docs-url",
-    type=str,
-    default=None,
-    help="The URL at which codelists documentation is available. The documentation must feature an HTML anchor matching the name of each codelist CSV file.",
-)
-@click.option(
-    "-w",
-    "--wkt",
-    is_flag=True,
-    default=True,
-    show_default=True,
-    help="Whether to use well-known text format in place of GeoJSON geometry objects.",
-)
-@click.option(
-    "-i",
-    "--input-rows",
-    type=int,
-    default=1000,
-    show_default=True,
-    help="The number of input rows.",
-)
-@click.option(
-    "-m",
-    "--main-sheet-name",
-    type=str,
-    default="main",
-    show_default=True,
-    help="The name of the main (parent) sheet.",
-)
-@click.option(
-    "-t",
-    "--truncation-length",
-    type=int,
-    default=10,
-    show_default=True,
-    help="The length of the components of sheet names.",
-)
-@click.option(
-    "-r",
-    "--rollup",
-    is_flag=True,
-    default=False,
-    show_default=True,
-    help="Whether to 'Roll up' columns from subsheets into the main sheet if they are specified in a rollUp attribute in the schema.",
-)
-@click.pass_context
-def create_template(
-    ctx,
-    schemafile,
-    output_file,
-    codelist_base_url,
-    codelist_docs_url,
-    wkt,
-    input_rows,
-    main_sheet_name,
-    truncation_length,
-    rollup
-):
+def parse_config(config):
     """
-    Generates a template from SCHEMAFILE for entering data in spreadsheet format.
-
-    SCHEMAFILE the JSON Schema file from which to generate the template. Additional options can be specified in a configuration file.
+    Validates configuration options not mapped to CLI options and returns them, with defaults for missing options. The
+    config is not modified, so that it can be reused between calls.
     """
-
-    # Parse configuration options not mapped to CLI options
-    if ctx.default_map:
+    if config:
 
         option_types = {
             "sheets": list,
@@ -170,455 +88,2510 @@ def create_template(
             "fixed_values": dict,
             "formulae": dict,
             "variables": dict,
-            "source_fields": dict
+            "source_fields": dict,
+            "schema_url": str,
         }
 
         # Validate types and set defaults
+        options = {}
         for option, t in option_types.items():
-            if ctx.default_map.get(option) and type(ctx.default_map.get(option)) != t:
+            value = config.get(option)
+            if value and type(value) != t:
                 raise TypeError(f"Config: {option} is not a {t}.")
-            elif ctx.default_map.get(option) is None:
-                if t == list:
-                    ctx.default_map[option] = []
-                elif t == dict:
-                    ctx.default_map[option] = {}
-                else:
-                    ctx.default_map[option] = None
-
-        sheets = {sheet: [] for sheet in ctx.default_map['sheets']}
-        include_fields = ctx.default_map['include_fields']
-        exclude_fields = ctx.default_map['exclude_fields']
-        package_metadata = ctx.default_map['package_metadata'] 
-        field_guidance = ctx.default_map['field_guidance']
-        fixed_values = ctx.default_map['fixed_values']
-        formulae = ctx.default_map['formulae']
-        variables = ctx.default_map['variables']
-        source_fields = {f"# {path}": field for path, field in ctx.default_map['source_fields'].items()}
+            elif value is None:
+                value = t() if t in (list, dict) else None
+            options[option] = value
+
+        options["source_fields"] = {f"# {path}": field for path, field in options["source_fields"].items()}
 
     else:
-        sheets = {}
-        include_fields = None
-        exclude_fields = None
-        package_metadata = {}
-        field_guidance = {}
-        fixed_values = {}
-        formulae = {}
-        variables = {}
-        source_fields = {}
-
-    if include_fields and exclude_fields:
+        options = {
+            "sheets": [],
+            "include_fields": None,
+            "exclude_fields": None,
+            "package_metadata": {},
+            "field_guidance": {},
+            "fixed_values": {},
+            "formulae": {},
+            "variables": {},
+            "source_fields": {},
+            "schema_url": None,
+        }
+
+    if options["include_fields"] and options["exclude_fields"]:
         raise RuntimeError("Config file must specify at most one of `include_fields` and `exclude_fields`.")
 
-    # Get schema file
-    with open(schemafile, 'r') as f:
-        schema = json.load(f)
+    return options
 
-    # Generate a temporary CSV template using Flatten Tool
-    temp_path = ".temp"
-    os.makedirs(temp_path, exist_ok=True)
-    command = f"flatten-tool create-template -s {schemafile} -f csv -m {main_sheet_name} -o {temp_path} --truncation-length {truncation_length}"
-    if wkt:
-        command = f"{command} --convert-wkt"
-    if rollup:
-        command = f"{command} --rollup"
-    print(f"Running Flatten Tool with command {command}")
-    subprocess.run(command.split(" "))
-
-    # Truncate CSV filenames to 31 characters for Excel compatibility
-    filenames = os.listdir(temp_path)
-    for index, filename in enumerate(filenames):
-        if filename.split(".")[-1] == "csv":
-            os.rename(
-                os.path.join(temp_path, filename),
-                os.path.join(
-                    temp_path, "".join([filename.split(".csv")[0][:31], ".csv"])
-                ),
-            )
 
-    # Get field metadata from schema
-    schema_table = mapping_sheet(schema, include_codelist=True, base_uri=schemafile)
-    field_metadata = {field["path"]: field for field in schema_table[1]}
-    
-    # Add source fields from config file
-    field_metadata.update(source_fields)
+def is_url(value):
+    """
+    Returns whether the value is an HTTP or HTTPS URL.
+    """
+    return value.startswith("http://") or value.startswith("https://")
 
-    # Create XLSX template
-    workbook = xlsxwriter.Workbook(output_file)
 
-    # Define order, row heights and cell formats for header rows
-    header_rows = {
-        "path": {
-            "row_height": None,
-            "cell_format": workbook.add_format({"bold": True, "bg_color": "#efefef"}),
-        },
-        "title": {
-            "row_height": None,
-            "cell_format": workbook.add_format({"bg_color": "#efefef"}),
-        },
-        "description": {
-            "row_height": 30,
-            "cell_format": workbook.add_format(
-                {
-                    "font_size": 8,
-                    "text_wrap": True,
-                    "valign": "top",
-                    "bg_color": "#efefef",
-                }
-            ),
-        },
-        "required": {
-            "row_height": None,
-            "cell_format": workbook.add_format({"font_size": 8, "bg_color": "#efefef"}),
-        },
-        "type": {
-            "row_height": None,
-            "cell_format": workbook.add_format({"font_size": 8, "bg_color": "#efefef"}),
-        },
-        "values": {
-            "row_height": 30,
-            "cell_format": workbook.add_format(
-                {
-                    "font_size": 8,
-                    "text_wrap": True,
-                    "valign": "top",
-                    "bg_color": "#efefef",
-                }
-            ),
-        },
-        "codelist": {
-            "row_height": None,
-            "cell_format": workbook.add_format(
-                {
-                    "font_size": 8,
-                    "font_color": "blue" if codelist_docs_url else "black",
-                    "underline": True if codelist_docs_url else False,
-                    "bg_color": "#efefef",
-                }
-            ),
-        },
-        "input guidance": {
-            "row_height": 50,
-            "cell_format": workbook.add_format(
-                {
-                    "font_size": 8,
-                    "text_wrap": True,
-                    "valign": "top",
-                    "bg_color": "#efefef",
-                    "bottom": 1,
-                }
-            ),
-        },
-    }
+def schema_refs(value):
+    """
+    Yields the values of the $ref properties in a JSON Schema, recursively.
+    """
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == "$ref" and isinstance(item, str):
+                yield item
+            else:
+                yield from schema_refs(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from schema_refs(item)
 
-    META_CONFIG.append(f"HeaderRows {len(header_rows)}"),
 
-    # Add header column cell format
-    header_col_format = workbook.add_format(
-        {
-            "bold": True,
-            "font_size": 11,
-            "font_color": "black",
-            "underline": False,
-            "bg_color": "#efefef",
-        }
-    )
+def local_schema_files(schemafile):
+    """
+    Returns the paths of the schema file and of the local files that it references with $ref, recursively.
+    """
+    if is_url(schemafile):
+        return []
 
-    # Add input cell formats
-    input_format = workbook.add_format({})
-    string_format = workbook.add_format({"num_format": "@"})
-    date_format = workbook.add_format({"num_format": "yyyy-mm-dd"})
-    number_format = workbook.add_format({"num_format": "#,##0.00"})
+    files = []
+    pending = [os.path.abspath(schemafile)]
+    while pending:
+        path = pending.pop()
+        if path in files or not os.path.isfile(path):
+            continue
+        files.append(path)
+        with open(path, "r") as f:
+            schema = json.load(f)
+        for ref in schema_refs(schema):
+            ref_path = ref.split("#")[0]
+            if ref_path and "://" not in ref_path:
+                pending.append(os.path.normpath(os.path.join(os.path.dirname(path), ref_path)))
 
-    # Add worksheet for enum validation
-    enum_worksheet = workbook.add_worksheet("# Enums")
-    enum_column = 0
+    return files
 
-    # Add meta worksheet for Flatten Tool configuration properties
-    meta_worksheet = workbook.add_worksheet("Meta")
-    meta_worksheet.hide()
-    meta_worksheet.write_row(0, 0, META_CONFIG)
-    for i, (key, value) in enumerate(package_metadata.items()):
-        meta_worksheet.write_row(i , 0, [key, value])
 
-    # Add variables worksheet for user-specified variables
-    if variables and len(variables) > 0:
-        variables_worksheet = workbook.add_worksheet("# Variables")
-        variables_worksheet.write_row(0, 0, ['Name', 'Value'])
-        for i, (key, value) in enumerate(variables.items()):
-            variables_worksheet.write_row(i+1, 0, [key, value])
-            workbook.define_name(key, f"='# Variables'!$B${i+2}")
+def fetch_schema_document(url, cache_dir, offline):
+    """
+    Returns the JSON document at the URL. The response is cached in the cache directory with its ETag and Last-Modified
+    validators, and the cached copy is revalidated with a conditional request, unless offline is set. The cached copy is
+    also used if the URL cannot be reached.
+    """
+    import requests
 
-    # Get list of CSV files produced by Flatten Tool
-    filenames = os.listdir(temp_path)
-    csv_files = [
-        filename.split(".")[0]
-        for filename in filenames
-        if filename.split(".")[-1] == "csv"
-    ]
+    name = hashlib.sha1(url.encode()).hexdigest()
+    body_path = os.path.join(cache_dir, f"{name}.source.json")
+    validators_path = os.path.join(cache_dir, f"{name}.validators.json")
+    cached = os.path.isfile(body_path) and os.path.isfile(validators_path)
 
-    # If sheets are specified in config file, warn on missing sheets and extra sheets
-    if len(sheets) > 0:
-        for sheet in [sheet for sheet in csv_files if sheet not in sheets]:
-            warnings.warn(
-                f"Skipping {sheet}. Flatten Tool outputs this sheet, but it is missing from the config file. To include this sheet in the template, update your config file."
-                )
-        for sheet in [sheet for sheet in sheets if sheet not in csv_files]:
-            warnings.warn(f"Ignoring sheet {sheet}. This sheet is specified in the config file but missing from Flatten Tool's output.")
-            del sheets[sheet]
-    # Otherwise, use sheets from Flatten Tool's output
-    else:
-        for sheet in csv_files:
-            sheets[sheet] = []
+    headers = {}
+    if cached:
+        if offline:
+            with open(body_path, "rb") as f:
+                return json.loads(f.read())
+        with open(validators_path, "r") as f:
+            validators = json.load(f)
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    elif offline:
+        raise RuntimeError(f"{url} is not in the schema cache. Run again without --offline to fetch it.")
 
-    for sheet in sheets:
+    try:
+        response = requests.get(url, headers=headers)
+    except requests.ConnectionError:
+        if not cached:
+            raise
+        warnings.warn(f"Using cached copy of {url}. The URL could not be reached.")
+        response = None
 
-        # Read column headers
-        file_path = os.path.join(temp_path, f"{sheet}.csv")
-        with open(file_path, "r") as f:
-            reader = csv.reader(f)
-            paths = []
-            for path in next(reader):
-                
-                # Add source fields from configuration file
-                if source_fields:
-                    for p, field in source_fields.items():
-                        if path == field['successor']:
-                            paths.append(p)
-                
-                if include_fields:
-                    if path in include_fields:
-                        paths.append(path)
-                elif exclude_fields:
-                    if path not in exclude_fields:
-                        paths.append(path)
-                else:
-                    paths.append(path)
-            
-            sheets[sheet] = paths
-
-        # Add worksheets, skip empty sheets and sheets that only include `id`
-        if len(sheets[sheet]) > 0 and sheets[sheet] != ['id']:
-            worksheet = workbook.add_worksheet(sheet)
-            worksheet.freeze_panes(1, 1)
-
-            # Set row formats
-            row = 0
-            for row_format in header_rows.values():
-                worksheet.set_row(row, row_format["row_height"], row_format["cell_format"])
-                row += 1
-
-            # Write header column
-            worksheet.write_column(0, 0, [f"# {row_name}" for row_name in header_rows])
-            worksheet.set_column(0, 0, 11, header_col_format)
-            column = 1
-
-            # Write metadata, formatting, input cells and data validation
-            for path in sheets[sheet]:
-
-                # Array indices are omitted from field paths in mapping sheet
-                metadata_path = "/".join([part for part in path.split("/") if part != "0"])
-
-                # Write field metadata as header rows
-                data_type = field_metadata[metadata_path].get("type")
-                values = field_metadata[metadata_path].get("values")
-                codelist = field_metadata[metadata_path].get("codelist")
-
-                # Generate codelist hyperlink formula
-                if codelist:
-                    codelist_name = codelist.split(".")[0]
-                    if codelist_docs_url:
-                        codelist_formula = f"""=HYPERLINK("{codelist_docs_url}#{codelist_name.replace("_", "-")}","{codelist_name}")"""
-                    else:
-                        codelist_formula = f'="{codelist_name}"'
-                else:
-                    codelist_formula = ""
-
-                metadata = {
-                    "path": path,
-                    "title": field_metadata[metadata_path].get("title"),
-                    "description": field_metadata[metadata_path].get("description"),
-                    "required": (
-                        "Required"
-                        if len(field_metadata[metadata_path].get("range", ""))
-                        and field_metadata[metadata_path]["range"][0] == "1"
-                        else ""
-                    ),
-                    "type": data_type,
-                    "values": values,
-                    "codelist": codelist_formula,
-                }
+    if response is None or response.status_code == 304:
+        with open(body_path, "rb") as f:
+            return json.loads(f.read())
 
-                # Add data input guidance
-                metadata["input guidance"] = ""
-                if path in field_guidance:
-                    metadata["input guidance"] += field_guidance[path]
-                if data_type == "array":
-                    if values[:4] == "Enum":
-                        metadata["input guidance"] = (
-                            "Select from list or enter multiple values as a semicolon-separated list, e.g. a;b;c. Each value must be a code from the codelist."
-                        )
-                    else:
-                        metadata["input guidance"] = (
-                            "Enter multiple values as a semicolon-separated list, e.g. a;b;c. Values must not contain semicolons or commas."
-                        )
-                elif wkt and path.split("/")[-1] == "geometry":
-                    metadata["input guidance"] = (
-                        "Enter a well-known text value, e.g. POLYGON ((30 10, 40 40, 20 40, 10 20, 30 10)). For more information on the well-known text representation of geometry, see https://en.wikipedia.org/wiki/Well-known_text_representation_of_geometry."
-                    )
+    response.raise_for_status()
+    os.makedirs(cache_dir, exist_ok=True)
+    write_file(body_path, response.content)
+    write_file(validators_path, json.dumps({
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }, indent=2) + "\n")
+    return json.loads(response.content)
 
-                worksheet.write_column(
-                    0, column, [metadata[row_name] for row_name in header_rows]
-                )
 
-                # Set cell format for input rows
-                if sheet == "links":
-                    cell_format = workbook.add_format({})
-                elif values == "date":
-                    cell_format = date_format
-                elif data_type == "number":
-                    cell_format = number_format
-                elif data_type in ["string", "array", "object"]:
-                    cell_format = string_format
-                else:
-                    cell_format = input_format
-
-                # Write input cells, use formulae to populate links sheet
-                input_row_ref = len(header_rows) + 1
-                if path in fixed_values:
-                    for i in range(input_rows):
-                            worksheet.write_formula(
-                                len(header_rows) + i,
-                                column,
-                                f'=IF(B{i + input_row_ref}="","","{fixed_values[path]}")',
-                                cell_format,
-                                "",
-                            )                     
-                elif path in formulae:
-                     for i in range(input_rows):
-                            worksheet.write_formula(
-                                len(header_rows) + i,
-                                column,
-                                formulae[path].replace("{row}", str(i + input_row_ref)),                      
-                                cell_format,
-                                "",
-                            )                     
-                elif sheet == "links":
-                    for i in range(input_rows):
-                        if path == "id":
-                            worksheet.write_formula(
-                                len(header_rows) + i,
-                                column,
-                                f'=IF(ISBLANK({main_sheet_name}!B{i + input_row_ref}),"",{main_sheet_name}!B{i + input_row_ref})',
-                                cell_format,
-                                "",
-                            )
-                        elif path == "links/0/href":
-                            worksheet.write_formula(
-                                len(header_rows) + i,
-                                column,
-                                f'=IF(B{i + input_row_ref}="","","{schema_url}")',
-                                cell_format,
-                                "",
-                            )
-                        elif path == "links/0/rel":
-                            worksheet.write_formula(
-                                len(header_rows) + i,
-                                column,
-                                f'=IF(B{i + input_row_ref}="","","describedby")',
-                                cell_format,
-                                "",
-                            )
+def resolve_schema(schemafile, cache_dir, offline, cache):
+    """
+    Returns the path of a local copy of the schema in which references to remote files are replaced with references to
+    local copies in the cache directory, so that Flatten Tool and OCDS Kit can both read the schema without network
+    access. Returns the schema file itself if it is a local file that references no remote files.
+
+    The $ref graph is fetched breadth-first, with the files at each level of the graph fetched concurrently. The cache
+    directory is created only if a remote file is fetched.
+    """
+    import concurrent.futures
+    from urllib.request import url2pathname
+
+    key = (schemafile, cache_dir, offline, modification_times(local_schema_files(schemafile)))
+    if cache.get("resolved_schema", (None,))[0] == key:
+        return cache["resolved_schema"][1]
+
+    def load(uri):
+        if uri.startswith("file:"):
+            with open(url2pathname(urllib.parse.urlparse(uri).path), "r") as f:
+                return json.load(f)
+        return fetch_schema_document(uri, cache_dir, offline)
+
+    def filename(uri):
+        return f"{hashlib.sha1(uri.encode()).hexdigest()}.json"
+
+    def rewrite(value, base_uri):
+        if isinstance(value, dict):
+            rewritten = {}
+            for key, item in value.items():
+                if key == "$ref" and isinstance(item, str) and not item.startswith("#"):
+                    uri, fragment = urllib.parse.urldefrag(urllib.parse.urljoin(base_uri, item))
+                    rewritten[key] = f"{filename(uri)}#{fragment}" if fragment else filename(uri)
                 else:
-                    worksheet.write_column(
-                        len(header_rows),
-                        column,
-                        ["" for i in range(input_rows)],
-                        cell_format,
-                    )
+                    rewritten[key] = rewrite(item, base_uri)
+            return rewritten
+        elif isinstance(value, list):
+            return [rewrite(item, base_uri) for item in value]
+        return value
 
-                # Set column width
-                worksheet.set_column(column, column, max(len(path), 16))
-
-                validation_options = None
-
-                # Set data validation for identifiers
-                # for name, paths in sheets.items():
-                #     if sheet == name:
-                #         break
-                #     elif path in paths:
-                #         column_ref = xl_col_to_name(paths.index(path) + 1)
-                #         validation_options = {
-                #             "validate": "list",
-                #             "source": f"={name}!${column_ref}${len(header_rows) + 1}:${column_ref}${input_rows}",
-                #         }
-                #         break
-
-                # Set data validation for codelists
-                if codelist and (values[:4] == "Enum" or codelist_base_url):
-                    validation_options = {"validate": "list"}
-
-                    if values[:4] == "Enum":
-                        codes = values[6:].split(", ")
-                        validation_options["error_title"] = "Value not in codelist"
-                        if data_type == "array":
-                            validation_options["error_type"] = "warning"
-                            validation_options["error_message"] = (
-                                "You must use a code from the codelist.\n\nIf no code is appropriate, please create an issue in the standard repository. If you entered multiple values from the codelist, you can ignore this warning."
-                            )
-                        else:
-                            validation_options["error_type"] = "stop"
-                            validation_options["error_message"] = (
-                                "You must use a code from the codelist.\n\nIf no code is appropriate, please create an issue in the standard."
-                            )
-                    elif codelist_base_url:
-                        codelist_csv = get(f"{codelist_base_url}{codelist}")
-                        codelist_reader = csv.DictReader(
-                            codecs.iterdecode(codelist_csv.iter_lines(), "utf-8")
-                        )
-                        codes = [row["Code"] for row in codelist_reader]
-                        validation_options["error_type"] = "warning"
-                        validation_options["error_title"] = "Value not in codelist"
-                        if data_type == "array":
-                            validation_options["error_message"] = (
-                                "You must use a code from the codelist, unless no code is appropriate.\n\nIf you use new codes outside those in an open codelist, please create an issue in the standard repository, so that the codes can be considered for inclusion in the codelist. If you entered multiple values from the codelist, you can ignore this warning."
-                            )
-                        else:
-                            validation_options["error_message"] = (
-                                "You must use a code from the codelist, unless no code is appropriate.\n\nIf you use new codes outside those in an open codelist, please create an issue in the standard repository, so that the codes can be considered for inclusion in the codelist."
-                            )
-
-                    enum_worksheet.write_column(0, enum_column, [path] + codes)
-                    enum_column_ref = xl_col_to_name(enum_column)
-                    validation_options["source"] = (
-                        f"='# Enums'!${enum_column_ref}$2:${enum_column_ref}${len(codes)+1}"
-                    )
-                    enum_column += 1
-
-                # Set data validation for dates
-                elif values == "date":
-                    validation_options = {
-                        "validate": "date",
-                        "criteria": ">=",
-                        "value": datetime.datetime(1, 1, 1),
-                    }
+    if is_url(schemafile):
+        root = schemafile
+    else:
+        root = pathlib.Path(os.path.realpath(schemafile)).as_uri()
 
-                if validation_options:
-                    worksheet.data_validation(
-                        len(header_rows), column, 1007, column, validation_options
-                    )
+    documents = {}
+    wave = [root]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        while wave:
+            documents.update(zip(wave, executor.map(load, wave)))
+            wave = sorted({
+                urllib.parse.urldefrag(urllib.parse.urljoin(uri, ref))[0]
+                for uri in wave
+                for ref in schema_refs(documents[uri])
+                if not ref.startswith("#")
+            } - documents.keys())
 
-                column += 1
+    if all(uri.startswith("file:") for uri in documents):
+        resolved = schemafile
+    else:
+        # Only write files whose content changed, so that their modification times identify changes
+        for uri, document in documents.items():
+            content = json.dumps(rewrite(document, uri), indent=2)
+            path = os.path.join(cache_dir, filename(uri))
+            if os.path.isfile(path):
+                with open(path, "r") as f:
+                    if f.read() == content:
+                        continue
+            write_file(path, content)
+        resolved = os.path.join(cache_dir, filename(root))
 
-    # Delete temp files
-    delete_directory_contents(".temp")
+    cache["resolved_schema"] = (key, resolved)
+    return resolved
 
-    # Write template to drive
-    workbook.get_worksheet_by_name(main_sheet_name).activate()
-    enum_worksheet.hide()
-    if workbook.get_worksheet_by_name("links"):
-        workbook.get_worksheet_by_name("links").hide()
 
-    workbook.close()
+def validate_schemafile(ctx, param, value):
+    """
+    Checks that the schema file is a URL or an existing local file.
+    """
+    if not is_url(value) and not os.path.exists(value):
+        raise click.BadParameter(f"Path '{value}' does not exist.")
+    return value
+
+
+def modification_times(paths):
+    """
+    Returns a tuple of (path, modification time) pairs for the given paths. Missing paths have a time of None.
+    """
+    return tuple(
+        (path, os.stat(path).st_mtime_ns if os.path.exists(path) else None)
+        for path in paths
+    )
+
+
+def intern(value):
+    """
+    Returns the interned string, if the value is a string, so that equal strings share memory.
+    """
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Field:
+    """
+    The metadata of a field that is used in templates, from a row of the mapping sheet or a source field in the config
+    file. Strings are interned, as schemas that reuse definitions repeat the same titles, descriptions and types for many
+    fields.
+    """
+    __slots__ = ("title", "description", "type", "values", "codelist", "required")
+
+    def __init__(self, row):
+        self.title = intern(row.get("title"))
+        self.description = intern(row.get("description"))
+        self.type = intern(row.get("type"))
+        self.values = intern(row.get("values"))
+        self.codelist = intern(row.get("codelist"))
+        self.required = bool(len(row.get("range", "")) and row["range"][0] == "1")
+
+
+def load_schema(schemafile, cache):
+    """
+    Returns the field metadata of the schema as Field objects, keyed by path. Reuses the cached metadata if the schema
+    file and the local files that it references are unchanged.
+    """
+    from ocdskit.mapping_sheet import mapping_sheet
+
+    key = modification_times(local_schema_files(schemafile))
+    if cache.get("schema", (None,))[0] != key:
+        with open(schemafile, 'r') as f:
+            schema = json.load(f)
+        base_uri = pathlib.Path(os.path.realpath(schemafile)).as_uri()
+        rows = mapping_sheet(schema, include_codelist=True, base_uri=base_uri)[1]
+        # Release each row once its Field is built, so that the rows and the Fields are not all held at once
+        rows.reverse()
+        field_metadata = {}
+        while rows:
+            row = rows.pop()
+            field_metadata[intern(row["path"])] = Field(row)
+        cache["schema"] = (key, field_metadata)
+        cache.pop("flatten_tool", None)
+
+    return cache["schema"][1]
+
+
+def flatten_tool_headers(schemafile, main_sheet_name, truncation_length, wkt, rollup, cache, on_event=None):
+    """
+    Generates a temporary CSV template using Flatten Tool and returns the column headers of each sheet, keyed by sheet
+    name. Reuses the cached headers if neither the schema nor the options have changed since the last run.
+    """
+    key = (main_sheet_name, truncation_length, wkt, rollup)
+    if cache.get("flatten_tool", (None,))[0] == key:
+        return cache["flatten_tool"][1]
+
+    # Each run writes to its own temporary directory, so that concurrent runs don't read each other's files
+    with tempfile.TemporaryDirectory() as temp_path:
+        command = f"flatten-tool create-template -s {schemafile} -f csv -m {main_sheet_name} -o {temp_path} --truncation-length {truncation_length}"
+        if wkt:
+            command = f"{command} --convert-wkt"
+        if rollup:
+            command = f"{command} --rollup"
+        if on_event:
+            emit(on_event, "flatten_tool_started", command=command)
+            # Flatten Tool's output is reported as an event, so that stderr is only made of events
+            process = subprocess.run(command.split(" "), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            emit(on_event, "flatten_tool_finished", returncode=process.returncode, stderr=process.stderr)
+        else:
+            click.echo(f"Running Flatten Tool with command {command}", err=True)
+            subprocess.run(command.split(" "))
+
+        # Read column headers from the CSV files produced by Flatten Tool. Truncate sheet names to 31 characters for
+        # Excel compatibility.
+        headers = {}
+        for filename in os.listdir(temp_path):
+            if filename.split(".")[-1] == "csv":
+                with open(os.path.join(temp_path, filename), "r") as f:
+                    headers[filename.split(".csv")[0][:31].split(".")[0]] = next(csv.reader(f))
+
+    cache["flatten_tool"] = (key, headers)
+    return headers
+
+
+def codelist_base(codelist_base_url=None, codelist_dir=None, codelist_archive=None):
+    """
+    Returns the location to which the name of each codelist CSV file is appended to read it: the base URL, or the
+    absolute path of the local directory or of the zip or tar archive, with a trailing separator.
+    """
+    if sum(bool(value) for value in (codelist_base_url, codelist_dir, codelist_archive)) > 1:
+        raise click.UsageError("Only one of --codelist-base-url, --codelist-dir and --codelist-archive can be set.")
+    if codelist_dir:
+        return os.path.join(os.path.abspath(codelist_dir), "")
+    if codelist_archive:
+        return os.path.join(os.path.abspath(codelist_archive), "")
+    return codelist_base_url
+
+
+def codelist_archive_index(archive, cache):
+    """
+    Returns the index of the files in a zip or tar archive, by file name. The files may be in any directory of the
+    archive. If two files have the same name, the first is used. Archives are indexed at most once per cache.
+
+    The index of a zip archive maps each file name to the member's info, from which it is read on demand. A tar archive
+    has no central directory, and may be compressed as a whole, so it is read once and the index maps the name of each
+    CSV file to its contents.
+    """
+    import tarfile
+    import zipfile
+
+    indexes = cache.setdefault("codelist_archives", {})
+    if archive not in indexes:
+        index = {}
+        if zipfile.is_zipfile(archive):
+            with zipfile.ZipFile(archive) as z:
+                for info in z.infolist():
+                    if not info.is_dir():
+                        index.setdefault(info.filename.rsplit("/", 1)[-1], info)
+        elif tarfile.is_tarfile(archive):
+            with tarfile.open(archive, "r|*") as tar:
+                for member in tar:
+                    if member.isfile() and member.name.endswith(".csv"):
+                        index.setdefault(member.name.rsplit("/", 1)[-1], tar.extractfile(member).read())
+        else:
+            raise click.UsageError(f"{archive} is not a zip or tar archive.")
+        indexes[archive] = index
+    return indexes[archive]
+
+
+def codelist_dir_index(directory, cache):
+    """
+    Returns the paths of the CSV files in a directory and its subdirectories, by file name. If two files have the same
+    name, the file nearest the top of the directory is used, then the first in alphabetical order. Directories are
+    indexed at most once per cache.
+    """
+    indexes = cache.setdefault("codelist_dirs", {})
+    if directory not in indexes:
+        index = {}
+        for root, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(".csv"):
+                    index.setdefault(filename, os.path.join(root, filename))
+        indexes[directory] = index
+    return indexes[directory]
+
+
+def read_zip_member(archive, info):
+    """
+    Returns the contents of a stored or deflated member of a zip archive, read with memory-mapped I/O from the offset in
+    the member's info.
+    """
+    import zipfile
+
+    with open(archive, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        # The local file header is 30 bytes, followed by the file name and extra field, whose lengths are at offset 26
+        name_length, extra_length = struct.unpack("<HH", m[info.header_offset + 26:info.header_offset + 30])
+        start = info.header_offset + 30 + name_length + extra_length
+        data = m[start:start + info.compress_size]
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        return zlib.decompress(data, -zlib.MAX_WBITS)
+    if info.compress_type == zipfile.ZIP_STORED:
+        return data
+    raise click.UsageError(f"{info.filename} in {archive} is not stored or deflated.")
+
+
+def parse_codes(lines):
+    """
+    Returns the codes in the lines of a codelist CSV file. The lines are bytes, and the codes are strings.
+    """
+    return [row["Code"] for row in csv.DictReader(codecs.iterdecode(lines, "utf-8"))]
+
+
+def read_local_codes(path, cache):
+    """
+    Returns the codes in a codelist CSV file in a local directory or archive, and the size of the file. As in an
+    archive, the file can be in any subdirectory of the directory. Files are read with memory-mapped I/O.
+    """
+    import zipfile
+
+    location, name = os.path.split(path)
+    if os.path.isfile(location):
+        index = codelist_archive_index(location, cache)
+        if name not in index:
+            raise click.UsageError(f"The codelist {name} is not in the codelist archive {location}.")
+        member = index[name]
+        if isinstance(member, zipfile.ZipInfo):
+            member = read_zip_member(location, member)
+        return parse_codes(io.BytesIO(member)), len(member)
+
+    index = codelist_dir_index(location, cache)
+    if name not in index:
+        raise click.UsageError(
+            f"The codelist {name} is not in the codelist directory {location} or its subdirectories."
+        )
+
+    with open(index[name], "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        # Empty files can't be memory-mapped
+        if not size:
+            return [], 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return parse_codes(iter(m.readline, b"")), size
+
+
+def get_codes(url, cache, on_event=None):
+    """
+    Returns the codes in the codelist CSV file at the given URL or local path, as returned by codelist_base. Each
+    codelist is read at most once per cache.
+    """
+    codelists = cache.setdefault("codelists", {})
+    cached = url in codelists
+    if not cached:
+        if is_url(url):
+            codelist_csv = get(url)
+            codelists[url] = (parse_codes(codelist_csv.iter_lines()), len(codelist_csv.content))
+        else:
+            codelists[url] = read_local_codes(url, cache)
+
+    codes, size = codelists[url]
+    emit(on_event, "codelist_fetched", url=url, bytes=size, cached=cached)
+    return codes
+
+
+def emit(on_event, event, **data):
+    """
+    Calls the event listener, if any, with a dict of the event name, the time and the event's data.
+    """
+    if on_event:
+        on_event({"event": event, "time": time.time(), **data})
+
+
+@contextlib.contextmanager
+def phase(on_event, name):
+    """
+    Emits events at the start and end of a phase of template generation.
+    """
+    if not on_event:
+        yield
+        return
+
+    start = time.perf_counter()
+    emit(on_event, "phase_started", phase=name)
+    yield
+    emit(on_event, "phase_finished", phase=name, seconds=time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def warning_events(on_event):
+    """
+    Emits warnings as events, instead of writing them to stderr, so that the stderr of a command with --events is only
+    made of events.
+    """
+    if not on_event:
+        yield
+        return
+
+    def showwarning(message, category, filename, lineno, file=None, line=None):
+        emit(on_event, "warning", category=category.__name__, message=str(message))
+
+    with warnings.catch_warnings():
+        warnings.showwarning = showwarning
+        yield
+
+
+def echo_event(event):
+    """
+    Writes an event to stderr as a line of JSON.
+    """
+    click.echo(json.dumps(event), err=True)
+
+
+def generate_template(
+    schemafile,
+    config,
+    output_file,
+    codelist_base_url,
+    codelist_docs_url,
+    wkt,
+    input_rows,
+    main_sheet_name,
+    truncation_length,
+    rollup,
+    schema_cache_dir=".schema-cache",
+    offline=False,
+    max_cells=None,
+    jobs=None,
+    plan_file=None,
+    on_event=None,
+    cache=None,
+    writer="xlsx",
+    codelist_dir=None,
+    codelist_archive=None,
+    compression_level=None,
+    compression_jobs=None,
+    sheet_cache_dir=None,
+):
+    """
+    Generates a template from a JSON Schema file and writes it to the output file.
+
+    The cache holds the parsed schema, Flatten Tool's output and the codelists between calls, so that only the stages
+    affected by a change are recomputed.
+
+    If max_cells is set, sheets are split across several workbooks of at most roughly that many cells each, which are
+    written concurrently across up to `jobs` processes, or as many processes as CPUs if `jobs` is not set. A sheet is
+    always written to the same workbook as the sheets of its parent array. A manifest listing the sheets in each workbook
+    is written alongside the workbooks.
+
+    Sheets are planned serially, or in parallel across `jobs` processes if `jobs` is greater than 1. If plan_file is set,
+    the plan is written to it as JSON.
+
+    If on_event is set, it is called with a dict for each event: the start and end of each phase, the fetching of each
+    codelist, the start and end of each sheet and the writing of each workbook.
+
+    The writer is the output format: "xlsx", "ods" or "csv" (a CSV bundle). If output_file is None, it defaults to the
+    writer's default output file.
+
+    Codelist CSV files are read from codelist_base_url, or from the local directory codelist_dir, or from the zip or tar
+    archive codelist_archive.
+
+    compression_level and compression_jobs are passed to the writer, if it supports them. If sheet_cache_dir is set, the
+    XLSX writer caches each sheet in that directory, and reuses the sheets that are unchanged since the last build.
+    """
+    import concurrent.futures
+
+    if cache is None:
+        cache = {}
+    codelist_base_url = codelist_base(codelist_base_url, codelist_dir, codelist_archive)
+    render = WRITERS[writer]
+    render_options = compression_options(writer, compression_level, compression_jobs)
+    if sheet_cache_dir:
+        if writer != "xlsx":
+            raise click.UsageError("--sheet-cache-dir is only supported by --writer xlsx.")
+        render_options["sheet_cache_dir"] = sheet_cache_dir
+    if output_file is None:
+        output_file = DEFAULT_OUTPUT_FILES[writer]
+
+    with phase(on_event, "prepare"):
+        options, sheets, field_metadata = prepare_template(
+            schemafile, config, main_sheet_name, truncation_length, wkt, rollup, schema_cache_dir, offline, cache,
+            on_event
+        )
+
+    with phase(on_event, "codelists"):
+        codelists = {
+            url: get_codes(url, cache, on_event)
+            for url in get_codelist_urls(sheets, field_metadata, codelist_base_url)
+        }
+
+    with phase(on_event, "plan"):
+        plan = plan_template(
+            sheets, field_metadata, codelists, options, codelist_base_url, codelist_docs_url, wkt, input_rows,
+            main_sheet_name, jobs
+        )
+        if plan_file:
+            json_dump(plan_file, plan)
+
+    if not max_cells:
+        with phase(on_event, "render"):
+            render(output_file, plan, on_event, **render_options)
+        return
+
+    shards = shard_sheets(sheets, main_sheet_name, input_rows, max_cells)
+    root, extension = os.path.splitext(output_file)
+    filenames = [f"{root}-{i + 1}{extension}" for i in range(len(shards))]
+
+    # Event listeners can't be passed to other processes, so events are emitted as each workbook is written
+    max_workers = min(len(shards), jobs or os.cpu_count() or 1)
+    with phase(on_event, "render"), concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                render, filename, {**plan, "sheets": {sheet: plan["sheets"][sheet] for sheet in shard}}, **render_options
+            ): (filename, shard)
+            for filename, shard in zip(filenames, shards)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+            filename, shard = futures[future]
+            emit(on_event, "workbook_written", file=filename, bytes=output_size(filename), sheets=list(shard))
+
+    json_dump(f"{root}.manifest.json", {
+        "workbooks": [
+            {"file": os.path.basename(filename), "sheets": list(shard)}
+            for filename, shard in zip(filenames, shards)
+        ],
+        "sheets": {
+            sheet: os.path.basename(filename)
+            for filename, shard in zip(filenames, shards)
+            for sheet in shard
+        },
+    })
+
+
+def prepare_template(
+    schemafile,
+    config,
+    main_sheet_name,
+    truncation_length,
+    wkt,
+    rollup,
+    schema_cache_dir,
+    offline,
+    cache,
+    on_event=None,
+):
+    """
+    Returns the options parsed from the config, the paths of the columns to include in each sheet and the field
+    metadata of each column, including source fields, keyed by column path.
+    """
+    options = parse_config(config)
+
+    # Fetch remote schema files and replace references to them with references to local copies
+    schemafile = resolve_schema(schemafile, schema_cache_dir, offline, cache)
+
+    # Get field metadata from schema
+    field_metadata = load_schema(schemafile, cache)
+
+    # Generate a temporary CSV template using Flatten Tool
+    headers = flatten_tool_headers(schemafile, main_sheet_name, truncation_length, wkt, rollup, cache, on_event)
+
+    # Add source fields from config file
+    field_metadata = {**field_metadata, **{path: Field(field) for path, field in options["source_fields"].items()}}
+
+    # Look up each column's field once, by its path without array indices, so that later stages look up column paths
+    sheets = select_sheets(headers, options)
+    column_fields = {path: field_metadata[strip_array_indices(path)] for paths in sheets.values() for path in paths}
+
+    return options, sheets, column_fields
+
+
+def get_codelist_urls(sheets, field_metadata, codelist_base_url):
+    """
+    Returns the URLs of the codelist CSV files from which to read codes, in the order in which they are first used.
+    Codelists whose codes are listed in the schema are not read from CSV files.
+    """
+    urls = {}
+    if codelist_base_url:
+        for paths in sheets.values():
+            for path in paths:
+                field = field_metadata[path]
+                if field.codelist and (field.values or "")[:4] != "Enum":
+                    urls[f"{codelist_base_url}{field.codelist}"] = None
+
+    return list(urls)
+
+
+def strip_array_indices(path):
+    """
+    Returns the path of a field in the mapping sheet. Array indices are omitted from field paths in the mapping sheet.
+    """
+    return "/".join([part for part in path.split("/") if part != "0"])
+
+
+def select_sheets(headers, options):
+    """
+    Returns the paths of the columns to include in each sheet, keyed by sheet name, in the order in which to add the
+    sheets to the template. Empty sheets and sheets that only include `id` are omitted.
+    """
+    sheets = {sheet: [] for sheet in options["sheets"]}
+    include_fields = options["include_fields"]
+    exclude_fields = options["exclude_fields"]
+    source_fields = options["source_fields"]
+
+    # Get list of CSV files produced by Flatten Tool
+    csv_files = list(headers)
+
+    # If sheets are specified in config file, warn on missing sheets and extra sheets
+    if len(sheets) > 0:
+        for sheet in [sheet for sheet in csv_files if sheet not in sheets]:
+            warnings.warn(
+                f"Skipping {sheet}. Flatten Tool outputs this sheet, but it is missing from the config file. To include this sheet in the template, update your config file."
+                )
+        for sheet in [sheet for sheet in sheets if sheet not in csv_files]:
+            warnings.warn(f"Ignoring sheet {sheet}. This sheet is specified in the config file but missing from Flatten Tool's output.")
+            del sheets[sheet]
+    # Otherwise, use sheets from Flatten Tool's output
+    else:
+        for sheet in csv_files:
+            sheets[sheet] = []
+
+    for sheet in sheets:
+
+        # Read column headers
+        paths = []
+        for path in headers[sheet]:
+
+            # Add source fields from configuration file
+            if source_fields:
+                for p, field in source_fields.items():
+                    if path == field['successor']:
+                        paths.append(p)
+
+            if include_fields:
+                if path in include_fields:
+                    paths.append(path)
+            elif exclude_fields:
+                if path not in exclude_fields:
+                    paths.append(path)
+            else:
+                paths.append(path)
+
+        sheets[sheet] = paths
+
+    return {
+        sheet: paths
+        for sheet, paths in sheets.items()
+        if len(paths) > 0 and paths != ['id']
+    }
+
+
+def shard_sheets(sheets, main_sheet_name, input_rows, max_cells):
+    """
+    Splits the sheets into groups of at most roughly max_cells cells each, preserving their order. The sheets of each
+    top-level array are kept in the same group, as are the main sheet and the `links` sheet, whose formulae refer to
+    the main sheet. A group of sheets that exceeds max_cells on its own is not split.
+    """
+    # Group sheets by the top-level array from which they are generated
+    groups = {}
+    for sheet, paths in sheets.items():
+        fields = [path for path in paths if path != "id" and not path.startswith("#")]
+        if sheet == "links" or not fields or any("/0/" not in path for path in fields):
+            key = main_sheet_name
+        else:
+            key = fields[0].split("/")[0]
+        groups.setdefault(key, {})[sheet] = paths
+
+    shards = []
+    shard = {}
+    cells = 0
+    for group in groups.values():
+        # The header column and header rows are small compared to the input rows, so are ignored
+        group_cells = sum(len(paths) for paths in group.values()) * input_rows
+        if shard and cells + group_cells > max_cells:
+            shards.append(shard)
+            shard = {}
+            cells = 0
+        shard.update(group)
+        cells += group_cells
+    if shard:
+        shards.append(shard)
+
+    return shards
+
+
+def header_rows(codelist_docs_url):
+    """
+    Returns the order, row heights and cell formats of the header rows.
+    """
+    return {
+        "path": {
+            "row_height": None,
+            "cell_format": {"bold": True, "bg_color": "#efefef"},
+        },
+        "title": {
+            "row_height": None,
+            "cell_format": {"bg_color": "#efefef"},
+        },
+        "description": {
+            "row_height": 30,
+            "cell_format": {
+                "font_size": 8,
+                "text_wrap": True,
+                "valign": "top",
+                "bg_color": "#efefef",
+            },
+        },
+        "required": {
+            "row_height": None,
+            "cell_format": {"font_size": 8, "bg_color": "#efefef"},
+        },
+        "type": {
+            "row_height": None,
+            "cell_format": {"font_size": 8, "bg_color": "#efefef"},
+        },
+        "values": {
+            "row_height": 30,
+            "cell_format": {
+                "font_size": 8,
+                "text_wrap": True,
+                "valign": "top",
+                "bg_color": "#efefef",
+            },
+        },
+        "codelist": {
+            "row_height": None,
+            "cell_format": {
+                "font_size": 8,
+                "font_color": "blue" if codelist_docs_url else "black",
+                "underline": True if codelist_docs_url else False,
+                "bg_color": "#efefef",
+            },
+        },
+        "input guidance": {
+            "row_height": 50,
+            "cell_format": {
+                "font_size": 8,
+                "text_wrap": True,
+                "valign": "top",
+                "bg_color": "#efefef",
+                "bottom": 1,
+            },
+        },
+    }
+
+
+# Cell format of the header column
+HEADER_COLUMN_FORMAT = {
+    "bold": True,
+    "font_size": 11,
+    "font_color": "black",
+    "underline": False,
+    "bg_color": "#efefef",
+}
+
+# Cell formats of input cells
+INPUT_FORMATS = {
+    "input": {},
+    "string": {"num_format": "@"},
+    "date": {"num_format": "yyyy-mm-dd"},
+    "number": {"num_format": "#,##0.00"},
+}
+
+
+def plan_template(
+    sheets,
+    field_metadata,
+    codelists,
+    options,
+    codelist_base_url,
+    codelist_docs_url,
+    wkt,
+    input_rows,
+    main_sheet_name,
+    jobs=None,
+):
+    """
+    Returns the plan of a template: the header rows, the Meta and `# Variables` sheets and the plan of each sheet.
+
+    The plan contains only JSON-serializable data, so that it can be cached and compared between builds. Sheets are
+    planned serially, or in parallel across `jobs` processes if `jobs` is greater than 1. Planning a sheet usually takes
+    less time than starting a process, so processes are only worth starting for very large schemas.
+    """
+    import concurrent.futures
+
+    rows = header_rows(codelist_docs_url)
+
+    if "links/0/href" in sheets.get("links", ()) and not options["schema_url"]:
+        warnings.warn(
+            "The links/0/href column of the links sheet is left blank. To fill it with the schema's URL, set schema_url "
+            "in the config file."
+        )
+
+    # Each process receives only the field metadata and codelists for its sheet
+    args = []
+    for sheet, paths in sheets.items():
+        sheet_fields = {}
+        sheet_codelists = {}
+        for path in paths:
+            field = field_metadata[path]
+            sheet_fields[path] = field
+            if field.codelist and codelist_base_url:
+                url = f"{codelist_base_url}{field.codelist}"
+                if url in codelists:
+                    sheet_codelists[url] = codelists[url]
+        args.append((
+            sheet, paths, sheet_fields, sheet_codelists, options, codelist_base_url, codelist_docs_url, wkt,
+            main_sheet_name
+        ))
+
+    if not jobs or jobs == 1 or len(args) < 2:
+        sheet_plans = [plan_sheet(*arg) for arg in args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            sheet_plans = list(executor.map(plan_sheet, *zip(*args)))
+
+    return {
+        "header_rows": rows,
+        "input_rows": input_rows,
+        "main_sheet_name": main_sheet_name,
+        "meta": {
+            "config": [*META_CONFIG, f"HeaderRows {len(rows)}"],
+            "metadata": options["package_metadata"],
+        },
+        "variables": options["variables"],
+        "sheets": dict(zip(sheets, sheet_plans)),
+    }
+
+
+def plan_sheet(
+    sheet,
+    paths,
+    field_metadata,
+    codelists,
+    options,
+    codelist_base_url,
+    codelist_docs_url,
+    wkt,
+    main_sheet_name,
+):
+    """
+    Returns the plan of a sheet: for each column, its header values, width, input cell format, formula template, data
+    validation and codes. In formula templates, `{row}` is substituted with the row number of each input row.
+
+    The field metadata is keyed by column path. The codes of a codelist that is read from a CSV file are None if the
+    codelist is not in `codelists`.
+    """
+    field_guidance = options["field_guidance"]
+    fixed_values = options["fixed_values"]
+    formulae = options["formulae"]
+    schema_url = options["schema_url"]
+
+    columns = []
+
+    # Plan metadata, formatting, input cells and data validation
+    for path in paths:
+
+        # Write field metadata as header rows
+        field = field_metadata[path]
+        data_type = field.type
+        values = field.values
+        codelist = field.codelist
+
+        # Generate codelist hyperlink formula
+        if codelist:
+            codelist_name = codelist.split(".")[0]
+            if codelist_docs_url:
+                codelist_formula = f"""=HYPERLINK("{codelist_docs_url}#{codelist_name.replace("_", "-")}","{codelist_name}")"""
+            else:
+                codelist_formula = f'="{codelist_name}"'
+        else:
+            codelist_formula = ""
+
+        metadata = {
+            "path": path,
+            "title": field.title,
+            "description": field.description,
+            "required": "Required" if field.required else "",
+            "type": data_type,
+            "values": values,
+            "codelist": codelist_formula,
+        }
+
+        # Add data input guidance
+        metadata["input guidance"] = ""
+        if path in field_guidance:
+            metadata["input guidance"] += field_guidance[path]
+        if data_type == "array":
+            if values[:4] == "Enum":
+                metadata["input guidance"] = (
+                    "Select from list or enter multiple values as a semicolon-separated list, e.g. a;b;c. Each value must be a code from the codelist."
+                )
+            else:
+                metadata["input guidance"] = (
+                    "Enter multiple values as a semicolon-separated list, e.g. a;b;c. Values must not contain semicolons or commas."
+                )
+        elif wkt and path.split("/")[-1] == "geometry":
+            metadata["input guidance"] = (
+                "Enter a well-known text value, e.g. POLYGON ((30 10, 40 40, 20 40, 10 20, 30 10)). For more information on the well-known text representation of geometry, see https://en.wikipedia.org/wiki/Well-known_text_representation_of_geometry."
+            )
+
+        # Set cell format for input rows
+        if sheet == "links":
+            cell_format = "input"
+        elif values == "date":
+            cell_format = "date"
+        elif data_type == "number":
+            cell_format = "number"
+        elif data_type in ["string", "array", "object"]:
+            cell_format = "string"
+        else:
+            cell_format = "input"
+
+        # Set formula for input cells, use formulae to populate links sheet
+        formula = None
+        if path in fixed_values:
+            formula = f'=IF(B{{row}}="","","{fixed_values[path]}")'
+        elif path in formulae:
+            formula = formulae[path]
+        elif sheet == "links":
+            if path == "id":
+                formula = f'=IF(ISBLANK({main_sheet_name}!B{{row}}),"",{main_sheet_name}!B{{row}})'
+            elif path == "links/0/href" and schema_url:
+                formula = f'=IF(B{{row}}="","","{schema_url}")'
+            elif path == "links/0/rel":
+                formula = '=IF(B{row}="","","describedby")'
+
+        validation_options = None
+        codes = None
+
+        # Set data validation for identifiers
+        # for name, paths in sheets.items():
+        #     if sheet == name:
+        #         break
+        #     elif path in paths:
+        #         column_ref = xl_col_to_name(paths.index(path) + 1)
+        #         validation_options = {
+        #             "validate": "list",
+        #             "source": f"={name}!${column_ref}${len(header_rows) + 1}:${column_ref}${input_rows}",
+        #         }
+        #         break
+
+        # Set data validation for codelists. The source is set when the codes are written to the enums sheet.
+        if codelist and (values[:4] == "Enum" or codelist_base_url):
+            validation_options = {"validate": "list"}
+
+            if values[:4] == "Enum":
+                codes = values[6:].split(", ")
+                validation_options["error_title"] = "Value not in codelist"
+                if data_type == "array":
+                    validation_options["error_type"] = "warning"
+                    validation_options["error_message"] = (
+                        "You must use a code from the codelist.\n\nIf no code is appropriate, please create an issue in the standard repository. If you entered multiple values from the codelist, you can ignore this warning."
+                    )
+                else:
+                    validation_options["error_type"] = "stop"
+                    validation_options["error_message"] = (
+                        "You must use a code from the codelist.\n\nIf no code is appropriate, please create an issue in the standard."
+                    )
+            elif codelist_base_url:
+                codes = codelists.get(f"{codelist_base_url}{codelist}")
+                validation_options["error_type"] = "warning"
+                validation_options["error_title"] = "Value not in codelist"
+                if data_type == "array":
+                    validation_options["error_message"] = (
+                        "You must use a code from the codelist, unless no code is appropriate.\n\nIf you use new codes outside those in an open codelist, please create an issue in the standard repository, so that the codes can be considered for inclusion in the codelist. If you entered multiple values from the codelist, you can ignore this warning."
+                    )
+                else:
+                    validation_options["error_message"] = (
+                        "You must use a code from the codelist, unless no code is appropriate.\n\nIf you use new codes outside those in an open codelist, please create an issue in the standard repository, so that the codes can be considered for inclusion in the codelist."
+                    )
+
+        # Set data validation for dates
+        elif values == "date":
+            validation_options = {
+                "validate": "date",
+                "criteria": ">=",
+                "value": "0001-01-01",
+            }
+
+        columns.append({
+            "path": path,
+            "header": list(metadata.values()),
+            "width": max(len(path), 16),
+            "format": cell_format,
+            "formula": formula,
+            # Columns in the links sheet without a formula have no input cells
+            "input": sheet != "links" or formula is not None,
+            "validation": validation_options,
+            "codes": codes,
+        })
+
+    return {"columns": columns}
+
+
+# Approximate costs of writing an input cell with xlsxwriter, measured on a template with 1000 input rows: seconds to
+# write, bytes in the compressed workbook and bytes of memory held until the workbook is closed.
+BLANK_CELL_COST = {"seconds": 10e-6, "bytes": 2.2, "memory": 115}
+FORMULA_CELL_COST = {"seconds": 68e-6, "bytes": 2.9, "memory": 210}
+
+# Approximate compressed size in bytes of an empty workbook, and of each additional sheet
+WORKBOOK_BYTES = 6600
+SHEET_BYTES = 1200
+
+
+def template_report(plan, codelist_urls, shards=None):
+    """
+    Returns the number of sheets, columns, input cells, formula cells, data validations and codes in the plan of a
+    template, and estimates of the size of the workbook and of the time and memory needed to write it.
+    """
+    input_rows = plan["input_rows"]
+    sheets = {}
+    for sheet, sheet_plan in plan["sheets"].items():
+        columns = sheet_plan["columns"]
+        sheets[sheet] = {
+            "columns": len(columns),
+            "input_cells": sum(input_rows for column in columns if column["input"]),
+            "formula_cells": sum(input_rows for column in columns if column["formula"] is not None),
+            "validations": sum(1 for column in columns if column["validation"]),
+            "enum_codes": sum(len(column["codes"]) for column in columns if column["codes"]),
+        }
+
+    report = {
+        "sheets": len(sheets),
+        "columns": sum(sheet["columns"] for sheet in sheets.values()),
+        "input_cells": sum(sheet["input_cells"] for sheet in sheets.values()),
+        "formula_cells": sum(sheet["formula_cells"] for sheet in sheets.values()),
+        "validations": sum(sheet["validations"] for sheet in sheets.values()),
+        "enum_codes": sum(sheet["enum_codes"] for sheet in sheets.values()),
+        "codelists_to_fetch": len(codelist_urls),
+    }
+    if shards is not None:
+        report["workbooks"] = len(shards)
+
+    blank_cells = report["input_cells"] - report["formula_cells"]
+    for estimate, key in (("estimated_bytes", "bytes"), ("estimated_seconds", "seconds"), ("estimated_memory_bytes", "memory")):
+        report[estimate] = blank_cells * BLANK_CELL_COST[key] + report["formula_cells"] * FORMULA_CELL_COST[key]
+    report["estimated_bytes"] = int(
+        report["estimated_bytes"] + report.get("workbooks", 1) * WORKBOOK_BYTES + report["sheets"] * SHEET_BYTES
+    )
+    report["estimated_seconds"] = round(report["estimated_seconds"], 2)
+    report["estimated_memory_bytes"] = int(report["estimated_memory_bytes"])
+
+    report["sheet_details"] = sheets
+    return report
+
+
+def enum_columns(plan):
+    """
+    Returns the columns of the `# Enums` sheet, each a list of a column's path and codes, and the index of the column of
+    the `# Enums` sheet assigned to each column with codes, keyed by sheet name and column index.
+    """
+    values = []
+    indices = {}
+    for sheet, sheet_plan in plan["sheets"].items():
+        for column, column_plan in enumerate(sheet_plan["columns"]):
+            if column_plan["validation"] and column_plan["codes"] is not None:
+                indices[(sheet, column)] = len(values)
+                values.append([column_plan["path"]] + column_plan["codes"])
+    return values, indices
+
+
+def render_workbook(
+    output_file,
+    plan,
+    on_event=None,
+    data=None,
+    constant_memory=False,
+    compression_level=None,
+    compression_jobs=None,
+    sheet_cache_dir=None,
+):
+    """
+    Writes an XLSX template from the plan of a template. If on_event is set, it is called with a dict for each event:
+    the start and end of each sheet and the writing of the workbook.
+
+    Cells are written row by row, so that the workbook can be written in xlsxwriter's constant memory mode. If data is
+    set, it maps sheet names to iterables of input rows, each a dict of column index and value, whose values are written
+    to the input cells of columns without formulae.
+
+    If compression_level or compression_jobs is set, the workbook's parts are compressed at that zlib compression level
+    (0 to store them uncompressed) across up to `compression_jobs` threads, instead of by xlsxwriter.
+
+    If sheet_cache_dir is set, the XML part of each sheet is cached in that directory by the sheet's fingerprint, and
+    the cached part of a sheet whose fingerprint is unchanged is reused instead of writing the sheet again. The workbook
+    is then written in constant memory mode, so that strings are written in each sheet's part instead of in the shared
+    strings table. Sheets with data are not cached.
+    """
+    import xlsxwriter
+    from xlsxwriter.utility import xl_col_to_name
+
+    input_rows = plan["input_rows"]
+    main_sheet_name = plan["main_sheet_name"]
+    variables = plan["variables"]
+    data = data or {}
+    capture = compression_level is not None or compression_jobs or sheet_cache_dir
+
+    # Create XLSX template
+    workbook = xlsxwriter.Workbook(output_file, {"constant_memory": constant_memory or bool(sheet_cache_dir)})
+    if capture:
+        parts = capture_parts(workbook)
+
+    # Add header row formats
+    header_rows = {
+        name: {"row_height": row["row_height"], "cell_format": workbook.add_format(row["cell_format"])}
+        for name, row in plan["header_rows"].items()
+    }
+
+    # Add header column cell format
+    header_col_format = workbook.add_format(HEADER_COLUMN_FORMAT)
+
+    # Add input cell formats
+    input_formats = {name: workbook.add_format(properties) for name, properties in INPUT_FORMATS.items()}
+
+    # xlsxwriter numbers cell formats in the order in which they are first used. Number them in the order in which they
+    # are added instead, so that a sheet's part doesn't depend on the other sheets.
+    for cell_format in [row["cell_format"] for row in header_rows.values()] + [header_col_format, *input_formats.values()]:
+        cell_format._get_xf_index()
+
+    active_sheet = main_sheet_name if main_sheet_name in plan["sheets"] else next(iter(plan["sheets"]))
+    cached_parts = {}
+
+    # Assign a column of the enums sheet to each column with codes
+    enum_values, enum_indices = enum_columns(plan)
+    enum_sources = {}
+    for key, index in enum_indices.items():
+        enum_column_ref = xl_col_to_name(index)
+        enum_sources[key] = f"='# Enums'!${enum_column_ref}$2:${enum_column_ref}${len(enum_values[index])}"
+
+    # Add worksheet for enum validation
+    enum_worksheet = workbook.add_worksheet("# Enums")
+    for row in range(max((len(values) for values in enum_values), default=0)):
+        enum_worksheet.write_row(row, 0, [values[row] if row < len(values) else None for values in enum_values])
+
+    # Add meta worksheet for Flatten Tool configuration properties
+    meta_worksheet = workbook.add_worksheet("Meta")
+    meta_worksheet.hide()
+    meta_worksheet.write_row(0, 0, plan["meta"]["config"])
+    for i, (key, value) in enumerate(plan["meta"]["metadata"].items()):
+        meta_worksheet.write_row(i , 0, [key, value])
+
+    # Add variables worksheet for user-specified variables
+    if variables and len(variables) > 0:
+        variables_worksheet = workbook.add_worksheet("# Variables")
+        variables_worksheet.write_row(0, 0, ['Name', 'Value'])
+        for i, (key, value) in enumerate(variables.items()):
+            variables_worksheet.write_row(i+1, 0, [key, value])
+            workbook.define_name(key, f"='# Variables'!$B${i+2}")
+
+    for sheet, sheet_plan in plan["sheets"].items():
+
+        columns = sheet_plan["columns"]
+        worksheet = workbook.add_worksheet(sheet)
+
+        # Reuse the cached part of an unchanged sheet. An empty worksheet is added in its place, whose part is replaced.
+        if sheet_cache_dir and sheet not in data:
+            sources = {column: source for (name, column), source in enum_sources.items() if name == sheet}
+            fingerprint = sheet_fingerprint(plan, sheet, sources, sheet == active_sheet, sheet == "links")
+            cache_path = os.path.join(sheet_cache_dir, f"{fingerprint}.xml")
+            reused = os.path.isfile(cache_path)
+            cached_parts[f"xl/worksheets/sheet{worksheet.index + 1}.xml"] = (cache_path, reused)
+            if reused:
+                emit(on_event, "sheet_reused", sheet=sheet, columns=len(columns))
+                continue
+
+        emit(on_event, "sheet_started", sheet=sheet, columns=len(columns))
+        worksheet.freeze_panes(1, 1)
+
+        # Set column widths and data validation
+        worksheet.set_column(0, 0, 11, header_col_format)
+        for column, column_plan in enumerate(columns):
+            worksheet.set_column(column + 1, column + 1, column_plan["width"])
+
+            validation_options = column_plan["validation"]
+            if validation_options:
+                validation_options = dict(validation_options)
+                if (sheet, column) in enum_sources:
+                    validation_options["source"] = enum_sources[(sheet, column)]
+                if validation_options["validate"] == "date":
+                    validation_options["value"] = datetime.datetime.fromisoformat(validation_options["value"])
+
+                worksheet.data_validation(
+                    len(header_rows), column + 1, len(header_rows) + input_rows - 1, column + 1, validation_options
+                )
+
+        # Write header column and field metadata as header rows
+        for row, (row_name, row_format) in enumerate(header_rows.items()):
+            worksheet.set_row(row, row_format["row_height"], row_format["cell_format"])
+            worksheet.write_row(row, 0, [f"# {row_name}"] + [column_plan["header"][row] for column_plan in columns])
+
+        # Write input cells
+        cell_formats = [input_formats[column_plan["format"]] for column_plan in columns]
+        rows = iter(data.get(sheet, ()))
+        for i in range(input_rows):
+            row = len(header_rows) + i
+            values = next(rows, {})
+            for column, column_plan in enumerate(columns):
+                if column_plan["formula"] is not None:
+                    worksheet.write_formula(
+                        row,
+                        column + 1,
+                        column_plan["formula"].replace("{row}", str(row + 1)),
+                        cell_formats[column],
+                        "",
+                    )
+                elif values.get(column) is not None:
+                    value = values[column]
+                    if isinstance(value, str):
+                        worksheet.write_string(row, column + 1, value, cell_formats[column])
+                    else:
+                        worksheet.write(row, column + 1, value, cell_formats[column])
+                elif column_plan["input"]:
+                    worksheet.write_blank(row, column + 1, None, cell_formats[column])
+
+        emit(on_event, "sheet_finished", sheet=sheet, columns=len(columns))
+
+    # Write template to drive
+    workbook.get_worksheet_by_name(active_sheet).activate()
+    enum_worksheet.hide()
+    if workbook.get_worksheet_by_name("links"):
+        workbook.get_worksheet_by_name("links").hide()
+
+    workbook.close()
+    if sheet_cache_dir:
+        os.makedirs(sheet_cache_dir, exist_ok=True)
+        for path, name, _ in parts:
+            if name in cached_parts:
+                cache_path, reused = cached_parts[name]
+                if reused:
+                    shutil.copyfile(cache_path, path)
+                else:
+                    with open(path, "rb") as f:
+                        write_file(cache_path, f.read())
+    if capture:
+        write_zip(output_file, parts, compression_level, compression_jobs)
+    emit(on_event, "workbook_written", file=output_file, bytes=os.path.getsize(output_file), sheets=list(plan["sheets"]))
+
+
+def sheet_fingerprint(plan, sheet, enum_sources, active, hidden):
+    """
+    Returns the fingerprint of a sheet's XML part: a hash of the sheet's plan (its columns' header values, formats,
+    formulae, validations and codes), the sources of its validations in the `# Enums` sheet, whether it is active or
+    hidden, and the plan's header rows and input rows, the cell formats and xlsxwriter's version.
+    """
+    import xlsxwriter
+
+    return hashlib.sha1(json.dumps([
+        plan["sheets"][sheet],
+        enum_sources,
+        active,
+        hidden,
+        plan["header_rows"],
+        plan["input_rows"],
+        HEADER_COLUMN_FORMAT,
+        INPUT_FORMATS,
+        xlsxwriter.__version__,
+    ], sort_keys=True).encode()).hexdigest()
+
+
+def capture_parts(workbook):
+    """
+    Makes the xlsxwriter workbook leave its parts on disk when it is closed, instead of adding them to the zip archive,
+    and returns the list to which the parts are then added, as tuples of temporary file path, part name and whether the
+    part is binary.
+    """
+    parts = []
+    get_packager = workbook._get_packager
+
+    # xlsxwriter's packager writes each part to a temporary file and returns the list of parts to add to the archive
+    def _get_packager():
+        packager = get_packager()
+        create_package = packager._create_package
+
+        def _create_package():
+            parts.extend(create_package())
+            return []
+
+        packager._create_package = _create_package
+        return packager
+
+    workbook._get_packager = _get_packager
+    return parts
+
+
+# The size of the chunks in which the parts of workbooks are read and compressed
+CHUNK_SIZE = 1 << 20
+
+
+def compress_part(path, level):
+    """
+    Reads a temporary file in chunks, and returns its CRC-32, its size and its contents compressed at the zlib
+    compression level.
+    """
+    crc = 0
+    size = 0
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    chunks = []
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            chunks.append(compressor.compress(chunk))
+    chunks.append(compressor.flush())
+    return crc, size, b"".join(chunks)
+
+
+def zip_header(signature, name, method, crc, compressed_size, size, offset=None):
+    """
+    Returns the local file header of a zip archive member, or its central directory header if offset is set. Members
+    have the 1980-01-01 timestamp that xlsxwriter uses for reproducible archives.
+    """
+    if max(compressed_size, size, offset or 0) >= 0xFFFFFFFF:
+        raise RuntimeError("The workbook is too large to compress with --compression-level or --compression-jobs.")
+    if offset is None:
+        return struct.pack("<IHHHHHIIIHH", signature, 20, 0, method, 0, 33, crc, compressed_size, size, len(name), 0)
+    return struct.pack(
+        "<IHHHHHHIIIHHHHHII", signature, 20, 20, 0, method, 0, 33, crc, compressed_size, size, len(name), 0, 0, 0, 0,
+        0, offset,
+    )
+
+
+def write_zip(filename, parts, level=None, jobs=None):
+    """
+    Writes the parts captured by capture_parts to a zip archive, replacing the archive written by xlsxwriter, and deletes
+    their temporary files.
+
+    With one job, or at compression level 0, each part is streamed to the archive in chunks, and its header is then
+    updated with its CRC-32 and sizes. Otherwise, the parts are compressed concurrently across `jobs` threads, in which
+    zlib releases the GIL, and each part is written in order as soon as it is compressed, with at most `jobs` compressed
+    parts held in memory.
+    """
+    import concurrent.futures
+    import zipfile
+
+    members = []
+
+    with open(filename, "wb") as f:
+        if level == 0 or not jobs or jobs == 1:
+            for path, name, _ in parts:
+                name = name.encode()
+                offset = f.tell()
+                method = zipfile.ZIP_STORED if level == 0 else zipfile.ZIP_DEFLATED
+                f.write(zip_header(0x04034B50, name, method, 0, 0, 0))
+                f.write(name)
+                crc = 0
+                size = 0
+                compressor = None
+                if method == zipfile.ZIP_DEFLATED:
+                    compressor = zlib.compressobj(
+                        zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, -zlib.MAX_WBITS
+                    )
+                with open(path, "rb") as part:
+                    for chunk in iter(lambda: part.read(CHUNK_SIZE), b""):
+                        crc = zlib.crc32(chunk, crc)
+                        size += len(chunk)
+                        f.write(compressor.compress(chunk) if compressor else chunk)
+                if compressor:
+                    f.write(compressor.flush())
+                os.remove(path)
+                end = f.tell()
+                compressed_size = end - offset - 30 - len(name)
+                f.seek(offset)
+                f.write(zip_header(0x04034B50, name, method, crc, compressed_size, size))
+                f.seek(end)
+                members.append((name, method, crc, compressed_size, size, offset))
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                pending = collections.deque()
+                for i, (path, _, _) in enumerate(parts):
+                    pending.append(executor.submit(compress_part, path, level))
+                    # Write the earliest part once `jobs` parts are being compressed, and at the end
+                    while pending and (len(pending) >= jobs or i == len(parts) - 1):
+                        crc, size, content = pending.popleft().result()
+                        path, name, _ = parts[len(members)]
+                        os.remove(path)
+                        name = name.encode()
+                        offset = f.tell()
+                        f.write(zip_header(0x04034B50, name, zipfile.ZIP_DEFLATED, crc, len(content), size))
+                        f.write(name)
+                        f.write(content)
+                        members.append((name, zipfile.ZIP_DEFLATED, crc, len(content), size, offset))
+
+        central_directory_offset = f.tell()
+        for name, method, crc, compressed_size, size, offset in members:
+            f.write(zip_header(0x02014B50, name, method, crc, compressed_size, size, offset))
+            f.write(name)
+        central_directory_size = f.tell() - central_directory_offset
+        f.write(struct.pack(
+            "<IHHHHIIH", 0x06054B50, 0, 0, len(members), len(members), central_directory_size,
+            central_directory_offset, 0,
+        ))
+
+
+# ODF equivalents of the xlsxwriter colour names used in cell formats
+ODS_COLORS = {"black": "#000000", "blue": "#0000ff"}
+
+ODS_NAMESPACES = (
+    'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+    'xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0" '
+    'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+    'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" '
+    'xmlns:fo="urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0" '
+    'xmlns:number="urn:oasis:names:tc:opendocument:xmlns:datastyle:1.0" '
+    'xmlns:of="urn:oasis:names:tc:opendocument:xmlns:of:1.2" '
+    'xmlns:msoxl="http://schemas.microsoft.com/office/excel/formula" '
+    'xmlns:config="urn:oasis:names:tc:opendocument:xmlns:config:1.0" '
+    'office:version="1.2"'
+)
+
+# Data styles of input cells
+ODS_DATA_STYLES = {
+    "string": '<number:text-style style:name="N-string"><number:text-content/></number:text-style>',
+    "date": (
+        '<number:date-style style:name="N-date"><number:year number:style="long"/><number:text>-</number:text>'
+        '<number:month number:style="long"/><number:text>-</number:text><number:day number:style="long"/>'
+        '</number:date-style>'
+    ),
+    "number": (
+        '<number:number-style style:name="N-number"><number:number number:decimal-places="2" '
+        'number:min-integer-digits="1" number:grouping="true"/></number:number-style>'
+    ),
+}
+
+
+def xml_escape(value):
+    """
+    Returns the value with the characters escaped that are special in XML text and in double-quoted attribute values.
+
+    This is used in place of xml.sax.saxutils, which imports urllib.request and would slow down every command.
+    """
+    return (
+        value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+        .replace("\n", "&#10;").replace("\r", "&#13;").replace("\t", "&#9;")
+    )
+
+
+def xml_attributes(attributes):
+    """
+    Returns XML attributes, omitting attributes whose values are None.
+    """
+    return "".join(f' {name}="{xml_escape(str(value))}"' for name, value in attributes.items() if value is not None)
+
+
+def ods_cell_style(name, properties, data_style=None):
+    """
+    Returns an ODF cell style from xlsxwriter cell format properties.
+    """
+    cell_properties = {
+        "fo:background-color": properties.get("bg_color"),
+        "fo:wrap-option": "wrap" if properties.get("text_wrap") else None,
+        "style:vertical-align": properties.get("valign"),
+        "fo:border-bottom": "0.5pt solid #000000" if properties.get("bottom") else None,
+    }
+    text_properties = {
+        "fo:font-weight": "bold" if properties.get("bold") else None,
+        "fo:font-size": f"{properties['font_size']}pt" if "font_size" in properties else None,
+        "fo:color": ODS_COLORS.get(properties.get("font_color"), properties.get("font_color")),
+    }
+    if properties.get("underline"):
+        text_properties.update({
+            "style:text-underline-style": "solid",
+            "style:text-underline-width": "auto",
+            "style:text-underline-color": "font-color",
+        })
+    attributes = {"style:name": name, "style:family": "table-cell", "style:data-style-name": data_style}
+    return (
+        f'<style:style{xml_attributes(attributes)}>'
+        f'<style:table-cell-properties{xml_attributes(cell_properties)}/>'
+        f'<style:text-properties{xml_attributes(text_properties)}/>'
+        '</style:style>'
+    )
+
+
+def ods_cell(value=None, formula=None, style=None, validation=None, repeat=1):
+    """
+    Returns an ODF table cell with the value or formula. Formulae are in Excel syntax. Strings are always written as
+    strings, even if they start with `=`.
+    """
+    attributes = {
+        "table:style-name": style,
+        "table:content-validation-name": validation,
+        "table:number-columns-repeated": repeat if repeat > 1 else None,
+    }
+    if formula is not None:
+        attributes.update({
+            "table:formula": f"msoxl:{formula}", "office:value-type": "string", "office:string-value": ""
+        })
+        return f"<table:table-cell{xml_attributes(attributes)}/>"
+    if isinstance(value, bool):
+        attributes.update({"office:value-type": "boolean", "office:boolean-value": str(value).lower()})
+        return f"<table:table-cell{xml_attributes(attributes)}/>"
+    if isinstance(value, (int, float)):
+        attributes.update({"office:value-type": "float", "office:value": value})
+        return f"<table:table-cell{xml_attributes(attributes)}/>"
+    if isinstance(value, datetime.date):
+        attributes.update({"office:value-type": "date", "office:date-value": value.isoformat()})
+        return f"<table:table-cell{xml_attributes(attributes)}/>"
+    if value is None or value == "":
+        return f"<table:table-cell{xml_attributes(attributes)}/>"
+    attributes["office:value-type"] = "string"
+    paragraphs = "".join(f"<text:p>{xml_escape(line)}</text:p>" for line in str(value).split("\n"))
+    return f"<table:table-cell{xml_attributes(attributes)}>{paragraphs}</table:table-cell>"
+
+
+def ods_header_cell(value, style):
+    """
+    Returns an ODF table cell with a header value. As in XLSX files, header values that start with `=`, like codelist
+    links, are written as formulae.
+    """
+    if isinstance(value, str) and value.startswith("="):
+        return ods_cell(formula=value, style=style)
+    return ods_cell(value, style=style)
+
+
+def render_ods(output_file, plan, on_event=None, data=None, compression_level=None):
+    """
+    Writes an ODS template from the plan of a template, for use with LibreOffice. Takes the same arguments as
+    render_workbook, except constant_memory and compression_jobs. The content is a single part, so it is compressed
+    in one thread.
+
+    Formulae are written in Excel syntax, which LibreOffice reads. The content is streamed to the archive row by row,
+    consecutive blank cells with the same style and validation are written once, and consecutive input rows without
+    formulae or values are written once.
+    """
+    import zipfile
+    from xlsxwriter.utility import xl_col_to_name
+
+    input_rows = plan["input_rows"]
+    main_sheet_name = plan["main_sheet_name"]
+    variables = plan["variables"]
+    header_count = len(plan["header_rows"])
+    data = data or {}
+
+    # Add header row, header column and input cell styles
+    styles = list(ODS_DATA_STYLES.values())
+    header_rows = []
+    for i, (name, row) in enumerate(plan["header_rows"].items()):
+        row_style = None
+        if row["row_height"]:
+            row_style = f"ro{i}"
+            styles.append(
+                f'<style:style style:name="{row_style}" style:family="table-row"><style:table-row-properties '
+                f'style:row-height="{row["row_height"] * 0.75}pt" style:use-optimal-row-height="false"/></style:style>'
+            )
+        styles.append(ods_cell_style(f"ce-header-{i}", row["cell_format"]))
+        header_rows.append((name, row_style, f"ce-header-{i}"))
+    styles.append(ods_cell_style("ce-header-column", HEADER_COLUMN_FORMAT))
+    for name, properties in INPUT_FORMATS.items():
+        styles.append(ods_cell_style(f"ce-{name}", properties, f"N-{name}" if name in ODS_DATA_STYLES else None))
+    styles.append(
+        '<style:style style:name="ta-hidden" style:family="table"><style:table-properties table:display="false"/>'
+        '</style:style>'
+    )
+
+    # Add column widths. xlsxwriter column widths are in characters.
+    column_styles = {}
+    widths = {column["width"] for sheet_plan in plan["sheets"].values() for column in sheet_plan["columns"]}
+    for width in sorted(widths | {11}):
+        column_styles[width] = f"co{len(column_styles)}"
+        styles.append(
+            f'<style:style style:name="{column_styles[width]}" style:family="table-column">'
+            f'<style:table-column-properties style:column-width="{width * 0.19:.2f}cm"/></style:style>'
+        )
+
+    # Assign a column of the enums sheet to each column with codes
+    enum_values, enum_indices = enum_columns(plan)
+
+    # Add data validation
+    validations = []
+    validation_names = {}
+    for sheet, sheet_plan in plan["sheets"].items():
+        for column, column_plan in enumerate(sheet_plan["columns"]):
+            validation_options = column_plan["validation"]
+            if not validation_options:
+                continue
+            name = f"val{len(validations) + 1}"
+            validation_names[(sheet, column)] = name
+            if validation_options["validate"] == "date":
+                condition = "of:cell-content-is-date()"
+            else:
+                enum_column_ref = xl_col_to_name(enum_indices[(sheet, column)])
+                length = len(enum_values[enum_indices[(sheet, column)]])
+                source = f"$'# Enums'.${enum_column_ref}$2:.${enum_column_ref}${length}"
+                condition = f"of:cell-content-is-in-list([{source}])"
+            error_message = ""
+            if "error_message" in validation_options:
+                message_type = "warning" if validation_options["error_type"] == "warning" else "stop"
+                paragraphs = "".join(
+                    f"<text:p>{xml_escape(line)}</text:p>" for line in validation_options["error_message"].split("\n")
+                )
+                attributes = {
+                    "table:title": validation_options["error_title"],
+                    "table:message-type": message_type,
+                    "table:display": "true",
+                }
+                error_message = f"<table:error-message{xml_attributes(attributes)}>{paragraphs}</table:error-message>"
+            attributes = {
+                "table:name": name,
+                "table:condition": condition,
+                "table:allow-empty-cell": "true",
+                "table:display-list": "unsorted",
+                "table:base-cell-address": f"$'{sheet}'.${xl_col_to_name(column + 1)}${header_count + 1}",
+            }
+            validations.append(
+                f"<table:content-validation{xml_attributes(attributes)}>{error_message}</table:content-validation>"
+            )
+
+    active_sheet = main_sheet_name if main_sheet_name in plan["sheets"] else next(iter(plan["sheets"]))
+
+    compression = zipfile.ZIP_STORED if compression_level == 0 else zipfile.ZIP_DEFLATED
+    with zipfile.ZipFile(output_file, "w", compression, compresslevel=compression_level) as archive:
+        # The mimetype must be the first file in the archive, and uncompressed
+        archive.writestr("mimetype", "application/vnd.oasis.opendocument.spreadsheet", zipfile.ZIP_STORED)
+        archive.writestr("META-INF/manifest.xml", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" manifest:version="1.2">'
+            '<manifest:file-entry manifest:full-path="/" manifest:media-type="application/vnd.oasis.opendocument.spreadsheet"/>'
+            '<manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>'
+            '<manifest:file-entry manifest:full-path="settings.xml" manifest:media-type="text/xml"/>'
+            '</manifest:manifest>'
+        ))
+
+        # Activate the main sheet and freeze the header rows and header column
+        split = "".join(
+            f'<config:config-item config:name="{name}" config:type="{item_type}">{value}</config:config-item>'
+            for name, item_type, value in (
+                ("HorizontalSplitMode", "short", 2), ("VerticalSplitMode", "short", 2),
+                ("HorizontalSplitPosition", "int", 1), ("VerticalSplitPosition", "int", header_count),
+                ("ActiveSplitRange", "short", 2), ("PositionLeft", "int", 0), ("PositionRight", "int", 1),
+                ("PositionTop", "int", 0), ("PositionBottom", "int", header_count),
+            )
+        )
+        tables = "".join(
+            f"<config:config-item-map-entry{xml_attributes({'config:name': sheet})}>{split}</config:config-item-map-entry>"
+            for sheet in plan["sheets"]
+        )
+        archive.writestr("settings.xml", (
+            f'<?xml version="1.0" encoding="UTF-8"?><office:document-settings {ODS_NAMESPACES}><office:settings>'
+            '<config:config-item-set config:name="ooo:view-settings"><config:config-item-map-indexed config:name="Views">'
+            f'<config:config-item-map-entry><config:config-item config:name="ActiveTable" config:type="string">'
+            f'{xml_escape(active_sheet)}</config:config-item><config:config-item-map-named config:name="Tables">{tables}'
+            '</config:config-item-map-named></config:config-item-map-entry></config:config-item-map-indexed>'
+            '</config:config-item-set></office:settings></office:document-settings>'
+        ))
+
+        with archive.open("content.xml", "w", force_zip64=True) as raw, io.TextIOWrapper(raw, "utf-8") as f:
+            f.write(f'<?xml version="1.0" encoding="UTF-8"?><office:document-content {ODS_NAMESPACES}>')
+            f.write(f'<office:automatic-styles>{"".join(styles)}</office:automatic-styles>')
+            f.write("<office:body><office:spreadsheet>")
+            if validations:
+                f.write(f'<table:content-validations>{"".join(validations)}</table:content-validations>')
+
+            def write_table(name, rows, hidden=False):
+                attributes = {"table:name": name, "table:style-name": "ta-hidden" if hidden else None}
+                f.write(f"<table:table{xml_attributes(attributes)}>")
+                for values in rows:
+                    f.write(f'<table:table-row>{"".join(ods_cell(value) for value in values)}</table:table-row>')
+                f.write("</table:table>")
+
+            # Add worksheet for enum validation
+            write_table("# Enums", (
+                [values[row] if row < len(values) else None for values in enum_values]
+                for row in range(max((len(values) for values in enum_values), default=0))
+            ), hidden=True)
+
+            # Add meta worksheet for Flatten Tool configuration properties. As in render_workbook, the first row of
+            # metadata is written over the configuration properties.
+            meta_rows = [list(plan["meta"]["config"])]
+            for i, (key, value) in enumerate(plan["meta"]["metadata"].items()):
+                if i < len(meta_rows):
+                    meta_rows[i][:2] = [key, value]
+                else:
+                    meta_rows.append([key, value])
+            write_table("Meta", meta_rows, hidden=True)
+
+            # Add variables worksheet for user-specified variables
+            if variables:
+                write_table("# Variables", [["Name", "Value"]] + [[key, value] for key, value in variables.items()])
+
+            for sheet, sheet_plan in plan["sheets"].items():
+
+                columns = sheet_plan["columns"]
+                emit(on_event, "sheet_started", sheet=sheet, columns=len(columns))
+                hidden = "ta-hidden" if sheet == "links" else None
+                f.write(f"<table:table{xml_attributes({'table:name': sheet, 'table:style-name': hidden})}>")
+
+                # Set column widths and default cell styles
+                f.write(
+                    f'<table:table-column table:style-name="{column_styles[11]}" '
+                    'table:default-cell-style-name="ce-header-column"/>'
+                )
+                for column_plan in columns:
+                    f.write(
+                        f'<table:table-column table:style-name="{column_styles[column_plan["width"]]}" '
+                        f'table:default-cell-style-name="ce-{column_plan["format"]}"/>'
+                    )
+
+                # Write header column and field metadata as header rows
+                for row, (row_name, row_style, cell_style) in enumerate(header_rows):
+                    f.write(f"<table:table-row{xml_attributes({'table:style-name': row_style})}>")
+                    f.write(ods_cell(f"# {row_name}", style=cell_style))
+                    f.write("".join(ods_header_cell(column_plan["header"][row], cell_style) for column_plan in columns))
+                    f.write("</table:table-row>")
+
+                # Blank input cells of each column, as a tuple of style and validation
+                blank_cells = [
+                    (f'ce-{column_plan["format"]}', validation_names.get((sheet, column)))
+                    if column_plan["input"] else (None, None)
+                    for column, column_plan in enumerate(columns)
+                ]
+
+                def write_input_row(row, values, count=1):
+                    attributes = {"table:number-rows-repeated": count if count > 1 else None}
+                    f.write(f"<table:table-row{xml_attributes(attributes)}>")
+                    f.write(ods_cell(style="ce-header-column"))
+                    # Consecutive blank cells with the same style and validation are written once
+                    blank = None
+                    repeat = 0
+                    for column, column_plan in enumerate(columns):
+                        style, validation = blank_cells[column]
+                        if column_plan["formula"] is not None:
+                            formula = column_plan["formula"].replace("{row}", str(row + 1))
+                            cell = ods_cell(formula=formula, style=style, validation=validation)
+                        elif values.get(column) is not None:
+                            cell = ods_cell(values[column], style=style, validation=validation)
+                        elif blank_cells[column] == blank:
+                            repeat += 1
+                            continue
+                        else:
+                            cell = None
+                        if repeat:
+                            f.write(ods_cell(style=blank[0], validation=blank[1], repeat=repeat))
+                        if cell is None:
+                            blank = blank_cells[column]
+                            repeat = 1
+                        else:
+                            f.write(cell)
+                            blank = None
+                            repeat = 0
+                    if repeat:
+                        f.write(ods_cell(style=blank[0], validation=blank[1], repeat=repeat))
+                    f.write("</table:table-row>")
+
+                # Write input cells
+                has_formulae = any(column_plan["formula"] is not None for column_plan in columns)
+                rows = iter(data.get(sheet, ()))
+                repeated = 0
+                for i in range(input_rows):
+                    values = next(rows, {})
+                    if not values and not has_formulae:
+                        repeated += 1
+                        continue
+                    if repeated:
+                        write_input_row(header_count + i - repeated, {}, repeated)
+                        repeated = 0
+                    write_input_row(header_count + i, values)
+                if repeated:
+                    write_input_row(header_count + input_rows - repeated, {}, repeated)
+
+                f.write("</table:table>")
+                emit(on_event, "sheet_finished", sheet=sheet, columns=len(columns))
+
+            if variables:
+                f.write("<table:named-expressions>")
+                for i, key in enumerate(variables):
+                    attributes = {
+                        "table:name": key,
+                        "table:cell-range-address": f"$'# Variables'.$B${i + 2}",
+                        "table:base-cell-address": "$'# Variables'.$A$1",
+                    }
+                    f.write(f"<table:named-range{xml_attributes(attributes)}/>")
+                f.write("</table:named-expressions>")
+            f.write("</office:spreadsheet></office:body></office:document-content>")
+
+    emit(on_event, "workbook_written", file=output_file, bytes=os.path.getsize(output_file), sheets=list(plan["sheets"]))
+
+
+def render_csv_bundle(output_file, plan, on_event=None, data=None):
+    """
+    Writes a CSV bundle from the plan of a template, for use in machine pipelines. The output file is a directory, to
+    which is written a CSV file of the header rows of each sheet, and a `template.json` file of the header row names,
+    the Meta and `# Variables` sheets, and each column's input cell format, formula, data validation and codes.
+
+    Input rows are not written. Data is not supported.
+    """
+    if data:
+        raise ValueError("Data is not supported by the CSV bundle writer.")
+
+    os.makedirs(output_file, exist_ok=True)
+    header_row_names = list(plan["header_rows"])
+
+    sheets = {}
+    for i, (sheet, sheet_plan) in enumerate(plan["sheets"].items()):
+        columns = sheet_plan["columns"]
+        emit(on_event, "sheet_started", sheet=sheet, columns=len(columns))
+
+        filename = f"{sheet}.csv"
+        with open(os.path.join(output_file, filename), "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            for row, row_name in enumerate(header_row_names):
+                writer.writerow([f"# {row_name}"] + [column_plan["header"][row] for column_plan in columns])
+
+        sheets[sheet] = {
+            "file": filename,
+            "columns": {
+                column_plan["path"]: {
+                    key: column_plan[key] for key in ("format", "formula", "validation", "codes") if column_plan[key]
+                }
+                for column_plan in columns
+            },
+        }
+        emit(on_event, "sheet_finished", sheet=sheet, columns=len(columns))
+
+    json_dump(os.path.join(output_file, "template.json"), {
+        "header_rows": header_row_names,
+        "input_rows": plan["input_rows"],
+        "main_sheet_name": plan["main_sheet_name"],
+        "meta": plan["meta"],
+        "variables": plan["variables"],
+        "sheets": sheets,
+    })
+    emit(on_event, "workbook_written", file=output_file, bytes=output_size(output_file), sheets=list(plan["sheets"]))
+
+
+def output_size(path):
+    """
+    Returns the size in bytes of a file, or of the files in a directory.
+    """
+    if os.path.isdir(path):
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    return os.path.getsize(path)
+
+
+# The function that writes each output format, and the default output file of each
+WRITERS = {"xlsx": render_workbook, "ods": render_ods, "csv": render_csv_bundle}
+DEFAULT_OUTPUT_FILES = {"xlsx": "template.xlsx", "ods": "template.ods", "csv": "template"}
+
+
+def compression_options(writer, compression_level=None, compression_jobs=None):
+    """
+    Returns the keyword arguments with which to call the writer to set the compression level and the number of threads
+    in which to compress. CSV bundles are not compressed, and ODS files are compressed in one thread.
+    """
+    options = {}
+    if writer in ("xlsx", "ods") and compression_level is not None:
+        options["compression_level"] = compression_level
+    if writer == "xlsx" and compression_jobs:
+        options["compression_jobs"] = compression_jobs
+    return options
+
+
+def read_filled_sheet(filename, sheet, columns, formula_columns, data_path):
+    """
+    Reads the input rows of a sheet of a filled template, in read-only mode, and writes them to data_path as a stream of
+    pickled dicts of column index and value, one per row. Each column of the sheet is mapped to the column in `columns`
+    with the same path, from the `# path` header row. Values in formula columns are not read, so that formulae are
+    recalculated.
+
+    Returns the number of rows up to the last non-empty row, and the paths of the sheet's columns that are not in
+    `columns`.
+    """
+    import openpyxl
+    import pickle
+
+    indices = {path: i for i, path in enumerate(columns)}
+    workbook = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+    try:
+        mapping = None
+        dropped = []
+        row_count = 0
+        rows_read = 0
+        with open(data_path, "wb") as f:
+            for row in workbook[sheet].iter_rows(values_only=True):
+                # Header rows start with a hash comment in the header column
+                if rows_read == 0 and row and isinstance(row[0], str) and row[0].startswith("#"):
+                    if row[0] == "# path":
+                        mapping = []
+                        for old, path in enumerate(row[1:], 1):
+                            if path in indices:
+                                if indices[path] not in formula_columns:
+                                    mapping.append((old, indices[path]))
+                            elif path is not None:
+                                dropped.append(path)
+                    continue
+
+                if mapping is None:
+                    raise RuntimeError(f"Sheet {sheet} of {filename} has no `# path` header row.")
+
+                values = {
+                    new: row[old]
+                    for old, new in mapping
+                    if old < len(row) and row[old] is not None and row[old] != ""
+                }
+                pickle.dump(values, f)
+                rows_read += 1
+                if values:
+                    row_count = rows_read
+    finally:
+        workbook.close()
+
+    return row_count, dropped
+
+
+def read_pickled_rows(data_path):
+    """
+    Yields the rows written by read_filled_sheet.
+    """
+    import pickle
+
+    with open(data_path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def template_options(f):
+    """
+    Adds the options shared by the commands that generate templates.
+    """
+    options = [
+        click.option(
+            "-c",
+            "--config-file",
+            type=click.Path(dir_okay=False),
+            callback=configure,
+            is_eager=True,
+            expose_value=False,
+            help="Read option defaults from the specified YAML file.",
+            show_default=True,
+        ),
+        click.option(
+            "-o",
+            "--output-file",
+            type=click.Path(),
+            default=None,
+            help="Path to which to write the template. Defaults to template.xlsx, template.ods or template, depending on --writer.",
+        ),
+        click.option(
+            "-b",
+            "--codelist-base-url",
+            type=str,
+            default=None,
+            help="The base URL at which codelist CSV files are available.",
+        ),
+        click.option(
+            "--codelist-dir",
+            type=click.Path(exists=True, file_okay=False),
+            default=None,
+            help="A local directory containing codelist CSV files, to use in place of --codelist-base-url.",
+        ),
+        click.option(
+            "--codelist-archive",
+            type=click.Path(exists=True, dir_okay=False),
+            default=None,
+            help="A local zip or tar archive containing codelist CSV files, in any directory, to use in place of --codelist-base-url.",
+        ),
+        click.option(
+            "-d",
+            "--codelist-docs-url",
+            type=str,
+            default=None,
+            help="The URL at which codelists documentation is available. The documentation must feature an HTML anchor matching the name of each codelist CSV file.",
+        ),
+        click.option(
+            "-w",
+            "--wkt",
+            is_flag=True,
+            default=True,
+            show_default=True,
+            help="Whether to use well-known text format in place of GeoJSON geometry objects.",
+        ),
+        click.option(
+            "-i",
+            "--input-rows",
+            type=int,
+            default=1000,
+            show_default=True,
+            help="The number of input rows.",
+        ),
+        click.option(
+            "-m",
+            "--main-sheet-name",
+            type=str,
+            default="main",
+            show_default=True,
+            help="The name of the main (parent) sheet.",
+        ),
+        click.option(
+            "-t",
+            "--truncation-length",
+            type=int,
+            default=10,
+            show_default=True,
+            help="The length of the components of sheet names.",
+        ),
+        click.option(
+            "-r",
+            "--rollup",
+            is_flag=True,
+            default=False,
+            show_default=True,
+            help="Whether to 'Roll up' columns from subsheets into the main sheet if they are specified in a rollUp attribute in the schema.",
+        ),
+        click.option(
+            "--writer",
+            type=click.Choice(list(WRITERS)),
+            default="xlsx",
+            show_default=True,
+            help="The output format: an XLSX workbook, an ODS spreadsheet, or a directory of CSV files of header rows with a JSON file of validations and codelists.",
+        ),
+        click.option(
+            "--compression-level",
+            type=click.IntRange(0, 9),
+            default=None,
+            help="The zlib compression level of XLSX and ODS files, from 0 (store uncompressed, fastest) to 9 (smallest). Defaults to 6.",
+        ),
+        click.option(
+            "--compression-jobs",
+            type=click.IntRange(1),
+            default=None,
+            help="The number of threads in which to compress the parts of XLSX files.",
+        ),
+        click.option(
+            "--sheet-cache-dir",
+            type=click.Path(file_okay=False),
+            default=None,
+            help="Cache each sheet of XLSX templates in this directory, and reuse the sheets that are unchanged since the last build.",
+        ),
+        click.option(
+            "--schema-cache-dir",
+            type=click.Path(file_okay=False),
+            default=".schema-cache",
+            show_default=True,
+            help="The directory in which to cache remote schema files.",
+        ),
+        click.option(
+            "--offline",
+            is_flag=True,
+            default=False,
+            show_default=True,
+            help="Whether to use cached remote schema files without revalidating them.",
+        ),
+        click.option(
+            "--max-cells",
+            type=int,
+            default=None,
+            help="Split the template into several workbooks of at most roughly this many input cells each.",
+        ),
+        click.option(
+            "-j",
+            "--jobs",
+            type=int,
+            default=None,
+            help="The number of processes in which to plan sheets and, with --max-cells, to write workbooks. By default, sheets are planned serially and workbooks are written in as many processes as CPUs.",
+        ),
+        click.option(
+            "--plan-file",
+            type=click.Path(dir_okay=False),
+            default=None,
+            help="Path to which to write the plan of the template as JSON.",
+        ),
+        click.option(
+            "--events",
+            is_flag=True,
+            default=False,
+            show_default=True,
+            help="Whether to write progress events to stderr as newline-delimited JSON.",
+        ),
+    ]
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument('schemafile', callback=validate_schemafile)
+@template_options
+@click.pass_context
+def create_template(
+    ctx,
+    schemafile,
+    output_file,
+    codelist_base_url,
+    codelist_dir,
+    codelist_archive,
+    codelist_docs_url,
+    wkt,
+    input_rows,
+    main_sheet_name,
+    truncation_length,
+    rollup,
+    writer,
+    compression_level,
+    compression_jobs,
+    sheet_cache_dir,
+    schema_cache_dir,
+    offline,
+    max_cells,
+    jobs,
+    plan_file,
+    events,
+):
+    """
+    Generates a template from SCHEMAFILE for entering data in spreadsheet format.
+
+    SCHEMAFILE the JSON Schema file or URL from which to generate the template. Additional options can be specified in a configuration file.
+    """
+    on_event = echo_event if events else None
+
+    with warning_events(on_event):
+        generate_template(
+            schemafile,
+            ctx.default_map,
+            output_file,
+            codelist_base_url,
+            codelist_docs_url,
+            wkt,
+            input_rows,
+            main_sheet_name,
+            truncation_length,
+            rollup,
+            schema_cache_dir,
+            offline,
+            max_cells,
+            jobs,
+            plan_file,
+            on_event,
+            writer=writer,
+            codelist_dir=codelist_dir,
+            codelist_archive=codelist_archive,
+            compression_level=compression_level,
+            compression_jobs=compression_jobs,
+            sheet_cache_dir=sheet_cache_dir,
+        )
+
+
+@cli.command()
+@click.argument('schemafile', callback=validate_schemafile)
+@template_options
+@click.option(
+    "-f",
+    "--format",
+    "report_format",
+    type=click.Choice(["text", "json"]),
+    default="text",
+    show_default=True,
+    help="The format of the report.",
+)
+@click.pass_context
+def plan(
+    ctx,
+    schemafile,
+    report_format,
+    output_file,
+    codelist_base_url,
+    codelist_dir,
+    codelist_archive,
+    codelist_docs_url,
+    wkt,
+    input_rows,
+    main_sheet_name,
+    truncation_length,
+    rollup,
+    writer,
+    compression_level,
+    compression_jobs,
+    sheet_cache_dir,
+    schema_cache_dir,
+    offline,
+    max_cells,
+    jobs,
+    plan_file,
+    events,
+):
+    """
+    Reports the size of the template that create-template would generate from SCHEMAFILE, without writing it.
+
+    SCHEMAFILE the JSON Schema file or URL from which to generate the template. Takes the same options as
+    create-template, except --output-file, --compression-level, --compression-jobs, --sheet-cache-dir and --writer ods
+    or csv on the command line, as the estimates are for an XLSX workbook written with the default compression. Codelist
+    CSV files are not downloaded, so codes from codelist CSV files are not counted.
+    """
+    # Options that only affect how the template is written are rejected if set on the command line. Config files that are
+    # shared with create-template can set them, and the estimates are for an XLSX workbook whatever the writer.
+    for name in ("output_file", "compression_level", "compression_jobs", "sheet_cache_dir"):
+        if ctx.get_parameter_source(name) == ParameterSource.COMMANDLINE:
+            raise click.UsageError(f"--{name.replace('_', '-')} is not supported by plan.")
+    if writer != "xlsx" and ctx.get_parameter_source("writer") == ParameterSource.COMMANDLINE:
+        raise click.UsageError(f"--writer {writer} is not supported by plan. Its estimates are for XLSX workbooks.")
+
+    on_event = echo_event if events else None
+
+    with warning_events(on_event):
+        codelist_base_url = codelist_base(codelist_base_url, codelist_dir, codelist_archive)
+
+        with phase(on_event, "prepare"):
+            options, sheets, field_metadata = prepare_template(
+                schemafile, ctx.default_map, main_sheet_name, truncation_length, wkt, rollup, schema_cache_dir, offline,
+                {}, on_event
+            )
+
+        with phase(on_event, "plan"):
+            template_plan = plan_template(
+                sheets, field_metadata, {}, options, codelist_base_url, codelist_docs_url, wkt, input_rows,
+                main_sheet_name, jobs
+            )
+            if plan_file:
+                json_dump(plan_file, template_plan)
+
+        shards = shard_sheets(sheets, main_sheet_name, input_rows, max_cells) if max_cells else None
+        report = template_report(template_plan, get_codelist_urls(sheets, field_metadata, codelist_base_url), shards)
+
+    if report_format == "json":
+        click.echo(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            if key != "sheet_details":
+                click.echo(f"{key.replace('_', ' ').capitalize()}: {value}")
+
+
+@cli.command()
+@click.argument('filled_template', type=click.Path(exists=True, dir_okay=False))
+@click.argument('schemafile', callback=validate_schemafile)
+@template_options
+@click.pass_context
+def migrate(
+    ctx,
+    filled_template,
+    schemafile,
+    output_file,
+    codelist_base_url,
+    codelist_dir,
+    codelist_archive,
+    codelist_docs_url,
+    wkt,
+    input_rows,
+    main_sheet_name,
+    truncation_length,
+    rollup,
+    writer,
+    compression_level,
+    compression_jobs,
+    sheet_cache_dir,
+    schema_cache_dir,
+    offline,
+    max_cells,
+    jobs,
+    plan_file,
+    events,
+):
+    """
+    Copies the data in FILLED_TEMPLATE to a new template generated from SCHEMAFILE, e.g. for a new version of a schema.
+
+    FILLED_TEMPLATE a template generated by create-template, with data entered. SCHEMAFILE the JSON Schema file or URL
+    from which to generate the new template. Takes the same options as create-template, except --max-cells,
+    --sheet-cache-dir and --writer csv.
+    """
+    import concurrent.futures
+    import openpyxl
+
+    if max_cells:
+        raise click.UsageError("--max-cells is not supported by migrate.")
+    if sheet_cache_dir:
+        raise click.UsageError("--sheet-cache-dir is not supported by migrate.")
+    if writer == "csv":
+        raise click.UsageError("--writer csv is not supported by migrate.")
+    if output_file is None:
+        output_file = DEFAULT_OUTPUT_FILES[writer]
+
+    on_event = echo_event if events else None
+
+    with warning_events(on_event):
+        codelist_base_url = codelist_base(codelist_base_url, codelist_dir, codelist_archive)
+        cache = {}
+
+        with phase(on_event, "prepare"):
+            options, sheets, field_metadata = prepare_template(
+                schemafile, ctx.default_map, main_sheet_name, truncation_length, wkt, rollup, schema_cache_dir, offline,
+                cache, on_event
+            )
+
+        with phase(on_event, "codelists"):
+            codelists = {
+                url: get_codes(url, cache, on_event)
+                for url in get_codelist_urls(sheets, field_metadata, codelist_base_url)
+            }
+
+        with phase(on_event, "plan"):
+            template_plan = plan_template(
+                sheets, field_metadata, codelists, options, codelist_base_url, codelist_docs_url, wkt, input_rows,
+                main_sheet_name, jobs
+            )
+            if plan_file:
+                json_dump(plan_file, template_plan)
+
+        workbook = openpyxl.load_workbook(filled_template, read_only=True)
+        filled_sheets = workbook.sheetnames
+        workbook.close()
+
+        for sheet in filled_sheets:
+            if sheet not in template_plan["sheets"] and sheet not in ("# Enums", "Meta", "# Variables"):
+                warnings.warn(f"Skipping {sheet}. This sheet is in the filled template but not in the new template.")
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+
+            # Read each sheet's input rows in a separate process
+            with phase(on_event, "read"), concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = {}
+                for sheet, sheet_plan in template_plan["sheets"].items():
+                    if sheet in filled_sheets:
+                        columns = [column["path"] for column in sheet_plan["columns"]]
+                        formula_columns = {
+                            i for i, column in enumerate(sheet_plan["columns"]) if column["formula"] is not None
+                        }
+                        data_path = os.path.join(temp_dir, f"{len(futures)}.pickle")
+                        future = executor.submit(
+                            read_filled_sheet, filled_template, sheet, columns, formula_columns, data_path
+                        )
+                        futures[future] = (sheet, data_path)
+
+                data = {}
+                for future in concurrent.futures.as_completed(futures):
+                    sheet, data_path = futures[future]
+                    row_count, dropped = future.result()
+                    for path in dropped:
+                        warnings.warn(f"Dropping {path} from {sheet}. This column is not in the new template.")
+                    data[sheet] = data_path
+
+                    # Add input rows to fit the data
+                    template_plan["input_rows"] = max(template_plan["input_rows"], row_count)
+
+            with phase(on_event, "render"):
+                WRITERS[writer](
+                    output_file,
+                    template_plan,
+                    on_event,
+                    data={sheet: read_pickled_rows(data_path) for sheet, data_path in data.items()},
+                    **({"constant_memory": True} if writer == "xlsx" else {}),
+                    **compression_options(writer, compression_level, compression_jobs),
+                )
+
+
+@cli.command()
+@click.argument('schemafile', callback=validate_schemafile)
+@template_options
+@click.option(
+    "--interval",
+    type=float,
+    default=0.5,
+    show_default=True,
+    help="The number of seconds between checks for changes.",
+)
+@click.pass_context
+def watch(ctx, schemafile, interval, **kwargs):
+    """
+    Generates a template from SCHEMAFILE and regenerates it whenever the schema, the local files that it references or
+    the configuration file change.
+
+    SCHEMAFILE the JSON Schema file from which to generate the template. Takes the same options as create-template.
+    """
+    config_file = ctx.meta.get("config_file")
+    if config_file:
+        config_file = os.path.abspath(config_file)
+    config = ctx.default_map
+    config_modified = dict(modification_times([config_file]))[config_file] if config_file else None
+    on_event = echo_event if kwargs.pop("events") else None
+    cache = {}
+    watched_files = [] if is_url(schemafile) else [os.path.abspath(schemafile)]
+    if config_file:
+        watched_files.append(config_file)
+    last_modified = None
+
+    while True:
+        # Each poll only checks the modification times of the known files. The schema's references are scanned again
+        # when a file changes.
+        modified = dict(modification_times(watched_files))
+
+        if modified != last_modified:
+            last_modified = modified
+            start = time.perf_counter()
+            # Report errors in files that are being edited, and wait for the next change
+            try:
+                watched_files = local_schema_files(schemafile)
+                if config_file:
+                    watched_files.append(config_file)
+                last_modified = dict(modification_times(watched_files))
+
+                # Reload the config file and apply it to options that are not set on the command line
+                if config_file and last_modified[config_file] != config_modified:
+                    import yaml
+
+                    with open(config_file, "r") as f:
+                        config = yaml.safe_load(f)
+                    config_modified = last_modified[config_file]
+                    for param in ctx.command.params:
+                        if param.name in kwargs and ctx.get_parameter_source(param.name) != ParameterSource.COMMANDLINE:
+                            value = (config or {}).get(param.name)
+                            kwargs[param.name] = param.default if value is None else value
+
+                with warning_events(on_event):
+                    generate_template(schemafile, config, on_event=on_event, cache=cache, **kwargs)
+            except Exception as e:
+                if on_event:
+                    emit(on_event, "error", message=str(e))
+                else:
+                    click.echo(f"Failed to generate template. Reason: {e}", err=True)
+            else:
+                output_file = kwargs["output_file"] or DEFAULT_OUTPUT_FILES[kwargs["writer"]]
+                click.echo(f"Wrote {output_file} in {time.perf_counter() - start:.2f}s")
+
+        time.sleep(interval)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,127 @@
+"""
+Compares the memory held by the field metadata of a schema, and the time to look up the metadata of each column, when
+stored as the mapping sheet's row dicts keyed by field path and when stored as Field objects keyed by column path.
+
+The schema is synthetic: like a schema with many extensions, it reuses a few definitions many times.
+
+Run from the root of the repository:
+
+    python -m tests.benchmark_field_metadata
+    python -m tests.benchmark_field_metadata --uses 1000 --definitions 50
+"""
+import gc
+import json
+import os
+import pathlib
+import tempfile
+import time
+import tracemalloc
+
+import click
+
+import manage
+
+ATTRIBUTES = ("title", "description", "type", "values", "codelist", "range")
+
+
+def synthetic_schema(uses, definitions, fields):
+    return {
+        "type": "object",
+        "properties": {
+            f"array{i}": {"type": "array", "items": {"$ref": f"#/definitions/Definition{i % definitions}"}}
+            for i in range(uses)
+        },
+        "definitions": {
+            f"Definition{i}": {
+                "type": "object",
+                "properties": {
+                    f"field{j}": {
+                        "title": f"Field {j}",
+                        "description": f"The description of field {j} of definition {i}, which is repeated by each use of "
+                        "the definition, as in the schemas of standards with many extensions.",
+                        "type": "string",
+                        "codelist": f"codelist{j}.csv",
+                        "openCodelist": True,
+                    }
+                    for j in range(fields)
+                },
+            }
+            for i in range(definitions)
+        },
+    }
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    index = build()
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return index, current, peak
+
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@click.command()
+@click.option("--uses", type=int, default=400, show_default=True, help="The number of uses of definitions.")
+@click.option("--definitions", type=int, default=20, show_default=True, help="The number of definitions.")
+@click.option("--fields", type=int, default=32, show_default=True, help="The number of fields in each definition.")
+@click.option("-r", "--repeat", type=int, default=5, show_default=True, help="The number of times to time lookups.")
+def main(uses, definitions, fields, repeat):
+    from ocdskit.mapping_sheet import mapping_sheet
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        schemafile = os.path.join(temp_dir, "schema.json")
+        with open(schemafile, "w") as f:
+            json.dump(synthetic_schema(uses, definitions, fields), f)
+
+        def rows():
+            with open(schemafile) as f:
+                schema = json.load(f)
+            base_uri = pathlib.Path(schemafile).as_uri()
+            return {row["path"]: row for row in mapping_sheet(schema, include_codelist=True, base_uri=base_uri)[1]}
+
+        def slotted():
+            field_metadata = manage.load_schema(schemafile, {})
+            column_paths = (path.replace("/", "/0/", 1) for path in field_metadata)
+            return {path: field_metadata[manage.strip_array_indices(path)] for path in column_paths}
+
+        row_index, row_current, row_peak = measure(rows)
+        field_index, field_current, field_peak = measure(slotted)
+
+    # Column paths, as output by Flatten Tool, include array indices
+    column_paths = list(field_index)
+
+    def row_lookups():
+        for path in column_paths:
+            for attribute in ATTRIBUTES:
+                row_index[manage.strip_array_indices(path)].get(attribute)
+
+    def field_lookups():
+        for path in column_paths:
+            field = field_index[path]
+            for attribute in ("title", "description", "type", "values", "codelist", "required"):
+                getattr(field, attribute)
+
+    row_seconds = best_time(row_lookups, repeat)
+    field_seconds = best_time(field_lookups, repeat)
+
+    click.echo(f"{len(column_paths)} columns from {uses} uses of {definitions} definitions of {fields} fields")
+    click.echo(f"{'index':28} {'held MB':>8} {'peak MB':>8} {'lookups ms':>11}")
+    for label, current, peak, seconds in (
+        ("row dicts by field path", row_current, row_peak, row_seconds),
+        ("Field objects by column path", field_current, field_peak, field_seconds),
+    ):
+        click.echo(f"{label:28} {current / 1e6:8.2f} {peak / 1e6:8.2f} {seconds * 1e3:11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Compares the time to write the same template plan with each writer, and the size of the output.
+
+Run from the root of the repository:
+
+    python -m tests.benchmark_writers
+    python -m tests.benchmark_writers path/to/schema.json --config-file config.yaml --input-rows 5000
+"""
+import os
+import tempfile
+import time
+
+import click
+
+import manage
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+@click.command()
+@click.argument("schemafile", default=os.path.join(FIXTURES, "schema.json"))
+@click.option("-c", "--config-file", type=click.Path(exists=True, dir_okay=False), help="A YAML configuration file.")
+@click.option("-i", "--input-rows", type=int, default=1000, show_default=True, help="The number of input rows.")
+@click.option("-r", "--repeat", type=int, default=3, show_default=True, help="The number of times to write each output.")
+def main(schemafile, config_file, input_rows, repeat):
+    import yaml
+
+    config = {}
+    if config_file:
+        with open(config_file) as f:
+            config = yaml.safe_load(f) or {}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache = {}
+        options, sheets, field_metadata = manage.prepare_template(
+            schemafile, config, "main", 10, True, False, os.path.join(temp_dir, ".schema-cache"), False, cache
+        )
+        plan = manage.plan_template(sheets, field_metadata, {}, options, None, None, True, input_rows, "main", 1)
+
+        click.echo(f"{len(plan['sheets'])} sheets, {input_rows} input rows, best of {repeat}")
+        click.echo(f"{'writer':8} {'seconds':>8} {'bytes':>12}")
+        for writer, render in manage.WRITERS.items():
+            output_file = os.path.join(temp_dir, manage.DEFAULT_OUTPUT_FILES[writer])
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                render(output_file, plan)
+                times.append(time.perf_counter() - start)
+            click.echo(f"{writer:8} {min(times):8.3f} {manage.output_size(output_file):12}")
+
+
+if __name__ == "__main__":
+    main()
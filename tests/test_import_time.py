@@ -0,0 +1,70 @@
+import json
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Importing the heavy dependencies took about 240 ms. Without them, importing manage takes about 40 ms, most of which is
+# click.
+IMPORT_TIME_BUDGET = 150_000  # microseconds
+
+LAZY_MODULES = (
+    "concurrent.futures",
+    "ocdskit",
+    "openpyxl",
+    "pickle",
+    "requests",
+    "tarfile",
+    "urllib.request",
+    "xlsxwriter",
+    "xml.sax.saxutils",
+    "yaml",
+    "zipfile",
+)
+
+
+def run(*args, check=True):
+    return subprocess.run([sys.executable, *args], cwd=ROOT, capture_output=True, text=True, check=check)
+
+
+def imported_modules(process):
+    return re.findall(r"^import time:\s+\d+ \|\s+\d+ \|\s+(\S+)$", process.stderr, re.MULTILINE)
+
+
+def test_import_does_not_load_lazy_modules():
+    # Some modules, like zipfile, can be imported by site, so only the modules imported by manage are checked.
+    process = run(
+        "-c",
+        "import json, sys; before = set(sys.modules); import manage; print(json.dumps(sorted(set(sys.modules) - before)))",
+    )
+
+    imported = json.loads(process.stdout)
+
+    assert [name for name in LAZY_MODULES if name in imported] == []
+
+
+def test_import_time():
+    times = []
+    for _ in range(3):
+        process = run("-X", "importtime", "-c", "import manage")
+        cumulative = re.search(r"^import time:\s+\d+ \|\s+(\d+) \| manage$", process.stderr, re.MULTILINE)
+        times.append(int(cumulative.group(1)))
+
+    assert min(times) < IMPORT_TIME_BUDGET
+
+
+def test_help():
+    process = run("-X", "importtime", "manage.py", "create-template", "--help")
+
+    assert "--config-file" in process.stdout
+    assert [name for name in ("requests", "xlsxwriter", "yaml") if name in imported_modules(process)] == []
+
+
+def test_usage_error_without_config_file():
+    # The --config-file callback runs, without a filename, before SCHEMAFILE is validated.
+    process = run("-X", "importtime", "manage.py", "create-template", "missing.json", check=False)
+
+    assert process.returncode == 2
+    assert [name for name in ("requests", "xlsxwriter", "yaml") if name in imported_modules(process)] == []
@@ -0,0 +1,97 @@
+import copy
+import gc
+import hashlib
+import os
+import resource
+import sys
+import tempfile
+import zipfile
+
+import openpyxl
+
+import manage
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+GENERATIONS = 1000
+
+# Each generation without a cache runs Flatten Tool, which takes about half a second.
+FRESH_GENERATIONS = 20
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+RSS_GROWTH_BUDGET = 10 * 1024 * 1024  # bytes
+
+
+def digest(filename):
+    # docProps/core.xml contains the creation time.
+    with zipfile.ZipFile(filename) as z:
+        return hashlib.sha1(b"".join(z.read(name) for name in sorted(z.namelist()) if name != "docProps/core.xml"))
+
+
+CONFIG = {
+    "input_rows": 20,
+    "field_guidance": {"name": "Enter the name"},
+    "fixed_values": {"amount": 5},
+    "variables": {"currency": "GBP"},
+    "package_metadata": {"version": "1.0"},
+}
+
+
+def generate(tmp_path, config, output_file, cache):
+    manage.generate_template(
+        os.path.join(FIXTURES, "schema.json"),
+        config,
+        output_file,
+        None,
+        None,
+        True,
+        config["input_rows"],
+        "main",
+        10,
+        False,
+        schema_cache_dir=os.path.join(tmp_path, ".schema-cache"),
+        jobs=1,
+        cache=cache,
+    )
+
+
+def test_soak(tmp_path):
+    config = copy.deepcopy(CONFIG)
+    output_file = os.path.join(tmp_path, "template.xlsx")
+    cache = {}
+
+    digests = set()
+    rss = []
+    for _ in range(GENERATIONS):
+        generate(tmp_path, config, output_file, cache)
+        digests.add(digest(output_file).hexdigest())
+        gc.collect()
+        rss.append(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT)
+
+    assert len(digests) == 1
+    assert config == CONFIG
+    # Allow the first generations to warm up caches and the allocator.
+    assert rss[-1] - rss[GENERATIONS // 10] < RSS_GROWTH_BUDGET
+
+    workbook = openpyxl.load_workbook(output_file)
+    assert any(row[:2] == ("version", "1.0") for row in workbook["Meta"].iter_rows(values_only=True))
+
+
+def test_soak_without_cache(tmp_path, monkeypatch):
+    # Without a cache, each generation runs Flatten Tool in its own temporary directory.
+    temp_dir = tmp_path / "tmp"
+    temp_dir.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(temp_dir))
+    config = copy.deepcopy(CONFIG)
+    output_file = os.path.join(tmp_path, "template.xlsx")
+
+    digests = set()
+    for _ in range(FRESH_GENERATIONS):
+        generate(tmp_path, config, output_file, None)
+        digests.add(digest(output_file).hexdigest())
+
+    assert len(digests) == 1
+    assert config == CONFIG
+    assert list(temp_dir.iterdir()) == []